@@ -0,0 +1,346 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Offline conversion benchmark.
+
+Imports one converter's FastAPI app in-process and drives it through ASGI with the test fixtures, no server or
+network involved. Reports per format latency percentiles, per stage timings, throughput at the requested
+concurrency levels and peak memory as JSON. Runs from a checkout of this folder, with the dependencies of the
+service installed, e.g.
+
+    python benchmark.py image --formats keras,tflite --runs 5 --concurrency 1,4 --output image.json
+
+The audio service also needs the speech commands preproc model, extracted from sc_preproc_model.tar.gz, in
+PREPROC_MODEL_PATH.
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Per service: the url type, the formats it converts, and its model and dataset fixtures.
+SERVICES = {
+    'image': {
+        'type': 'image',
+        'formats': ['keras', 'savedmodel', 'tflite', 'tflite_quantized', 'edgetpu'],
+        'model': 'image/test/image-model.zip',
+        'dataset': 'image/test/image-model-data.zip',
+    },
+    'tiny': {
+        'type': 'tiny_image',
+        'formats': ['keras', 'tflite', 'tinyml'],
+        'model': 'tiny/test/tiny-image-model.zip',
+        'dataset': 'tiny/test/image-model-data.zip',
+    },
+    'audio': {
+        'type': 'audio',
+        'formats': ['tflite'],
+        'model': 'audio/test/audio-model-data.zip',
+        'dataset': None,
+    },
+}
+READY_TIMEOUT_SECONDS = 600
+
+
+def load_app(service):
+    # The services resolve their templates and preproc models relative to their own directory.
+    service_dir = os.path.join(ROOT, service)
+    if service == 'audio':
+        # Only the audio image downloads the preproc model, a checkout doesn't have it.
+        preproc_path = os.path.abspath(os.environ.get('PREPROC_MODEL_PATH',
+                                                      os.path.join(service_dir, 'sc_preproc_model')))
+        if not os.path.isdir(preproc_path):
+            sys.exit('no preproc model at {}, set PREPROC_MODEL_PATH to an extracted sc_preproc_model'
+                     .format(preproc_path))
+        os.environ['PREPROC_MODEL_PATH'] = preproc_path
+    os.chdir(service_dir)
+    # The services are thin wrappers around the shared tmconverter package next to them.
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('SKETCH_TEMPLATE_DIR', os.path.join(ROOT, 'tiny', 'sketch_templates', 'tm_template_script'))
+    spec = importlib.util.spec_from_file_location('api', os.path.join(service_dir, 'api.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['api'] = module
+    spec.loader.exec_module(module)
+    return module.app
+
+
+class RssSampler:
+    """Samples the resident set size in the background, so each phase gets its own peak."""
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    @staticmethod
+    def rss():
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def run(self):
+        while True:
+            rss = self.rss()
+            with self.lock:
+                self.peak = max(self.peak, rss)
+            time.sleep(self.interval)
+
+    def reset(self):
+        with self.lock:
+            self.peak = self.rss()
+
+    def read(self):
+        with self.lock:
+            return max(self.peak, self.rss())
+
+
+def multipart_body(files):
+    boundary = uuid.uuid4().hex
+    body = bytearray()
+    for field, path in files:
+        with open(path, 'rb') as f:
+            data = f.read()
+        body += '--{}\r\n'.format(boundary).encode()
+        body += 'Content-Disposition: form-data; name="{}"; filename="{}"\r\n'.format(field, os.path.basename(path)).encode()
+        body += b'Content-Type: application/zip\r\n\r\n'
+        body += data + b'\r\n'
+    body += '--{}--\r\n'.format(boundary).encode()
+    return bytes(body), 'multipart/form-data; boundary=' + boundary
+
+
+async def call(app, method, path, query='', body=b'', content_type=None):
+    """Runs one request through the ASGI app and returns (status, headers, body size)."""
+    headers = [(b'host', b'benchmark'), (b'content-length', str(len(body)).encode())]
+    if content_type:
+        headers.append((b'content-type', content_type.encode()))
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method, 'scheme': 'http',
+        'path': path, 'root_path': '', 'query_string': query.encode(), 'headers': headers,
+        'client': ('127.0.0.1', 0), 'server': ('benchmark', 80),
+    }
+    done = asyncio.Event()
+    request_sent = False
+    response = {'status': None, 'headers': {}, 'size': 0}
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = {k.decode().lower(): v.decode() for k, v in message.get('headers', [])}
+        elif message['type'] == 'http.response.body':
+            response['size'] += len(message.get('body', b''))
+            if not message.get('more_body', False):
+                done.set()
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        done.set()
+    return response['status'], response['headers'], response['size']
+
+
+async def start_app(app):
+    # Runs the lifespan protocol so the startup hooks (the warm-up) run like they do under uvicorn.
+    messages = asyncio.Queue()
+    started = asyncio.get_event_loop().create_future()
+    await messages.put({'type': 'lifespan.startup'})
+
+    async def send(message):
+        if message['type'].startswith('lifespan.startup') and not started.done():
+            started.set_result(message)
+
+    task = asyncio.ensure_future(app({'type': 'lifespan', 'asgi': {'version': '3.0'}}, messages.get, send))
+    message = await started
+    if message['type'] != 'lifespan.startup.complete':
+        raise RuntimeError('startup failed: ' + message.get('message', ''))
+
+    async def stop():
+        await messages.put({'type': 'lifespan.shutdown'})
+        await task
+    return stop
+
+
+async def wait_ready(app):
+    deadline = time.time() + READY_TIMEOUT_SECONDS
+    while time.time() < deadline:
+        status, _, _ = await call(app, 'GET', '/ready')
+        if status == 200:
+            return
+        await asyncio.sleep(0.5)
+    raise RuntimeError('converter did not become ready')
+
+
+def percentiles(values):
+    values = sorted(values)
+    def at(q):
+        position = (len(values) - 1) * q
+        low = int(position)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (position - low)
+    return {
+        'min': values[0], 'mean': sum(values) / len(values), 'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99),
+        'max': values[-1],
+    }
+
+
+async def convert(app, service, format, body, content_type):
+    start = time.time()
+    status, headers, size = await call(app, 'POST', '/convert/{}/{}'.format(service['type'], format),
+                                       body=body, content_type=content_type)
+    seconds = time.time() - start
+    if status != 200:
+        raise RuntimeError('{} conversion answered {}'.format(format, status))
+    return seconds, json.loads(headers.get('x-conversion-timing', '[]')), size
+
+
+async def benchmark_latency(app, service, format, body, content_type, runs, warmup_runs, sampler):
+    for _ in range(warmup_runs):
+        await convert(app, service, format, body, content_type)
+    sampler.reset()
+    latencies = []
+    stages = {}
+    size = 0
+    for _ in range(runs):
+        seconds, timings, size = await convert(app, service, format, body, content_type)
+        latencies.append(seconds)
+        for timing in timings:
+            stages.setdefault(timing['stage'], []).append(timing['seconds'])
+    return {
+        'runs': runs,
+        'latency_seconds': percentiles(latencies),
+        'stage_seconds': {stage: sum(values) / len(values) for stage, values in stages.items()},
+        'response_bytes': size,
+        'peak_rss_bytes': sampler.read(),
+    }
+
+
+async def benchmark_throughput(app, service, format, body, content_type, concurrency, sampler):
+    sampler.reset()
+    start = time.time()
+    results = await asyncio.gather(*[convert(app, service, format, body, content_type) for _ in range(concurrency)])
+    seconds = time.time() - start
+    return {
+        'format': format,
+        'concurrency': concurrency,
+        'seconds': seconds,
+        'requests_per_second': concurrency / seconds,
+        'latency_seconds': percentiles([latency for latency, _, _ in results]),
+        'peak_rss_bytes': sampler.read(),
+    }
+
+
+async def run(args):
+    service = SERVICES[args.service]
+    files = [('model', args.model or os.path.join(ROOT, service['model']))]
+    dataset = args.dataset or (service['dataset'] and os.path.join(ROOT, service['dataset']))
+    if dataset:
+        files.append(('dataset', dataset))
+    files = [(field, os.path.abspath(path)) for field, path in files]
+    formats = args.formats.split(',') if args.formats else service['formats']
+    body, content_type = multipart_body(files)
+
+    sampler = RssSampler()
+    start = time.time()
+    app = load_app(args.service)
+    import_seconds = time.time() - start
+    stop_app = await start_app(app)
+    await wait_ready(app)
+    ready_seconds = time.time() - start
+
+    results = {
+        'service': args.service,
+        'python': platform.python_version(),
+        'tensorflow': sys.modules['tensorflow'].__version__ if 'tensorflow' in sys.modules else None,
+        'cpu_count': os.cpu_count(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'fixtures': {field: os.path.basename(path) for field, path in files},
+        'backbones': sorted(name for name in os.listdir(os.environ['BACKBONE_DIR']) if name.endswith('.tflite')),
+        'import_seconds': import_seconds,
+        'ready_seconds': ready_seconds,
+        # Import time of every heavy module, measured by the converter while it loaded its backend.
+        'module_import_seconds': dict(sys.modules['tmconverter.metrics'].import_seconds),
+        'formats': {},
+        'throughput': [],
+    }
+    for format in formats:
+        print('benchmarking ' + format, flush=True)
+        results['formats'][format] = await benchmark_latency(
+            app, service, format, body, content_type, args.runs, args.warmup_runs, sampler)
+    for concurrency in args.concurrency:
+        for format in formats:
+            print('benchmarking {} x{}'.format(format, concurrency), flush=True)
+            results['throughput'].append(await benchmark_throughput(
+                app, service, format, body, content_type, concurrency, sampler))
+    results['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    await stop_app()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks a converter in-process with the test fixtures.')
+    parser.add_argument('service', choices=sorted(SERVICES))
+    parser.add_argument('--formats', help='comma separated formats, defaults to every format of the service')
+    parser.add_argument('--runs', type=int, default=5, help='timed conversions per format')
+    parser.add_argument('--warmup-runs', type=int, default=1, help='untimed conversions per format before the timed ones')
+    parser.add_argument('--concurrency', default='1,4', help='comma separated numbers of simultaneous requests')
+    parser.add_argument('--model', help='model zip, defaults to the service test fixture')
+    parser.add_argument('--dataset', help='dataset zip, defaults to the service test fixture')
+    parser.add_argument('--cache', action='store_true', help='keep the conversion cache enabled')
+    parser.add_argument('--backbone-dir', help='quantized feature extractors to splice image models onto '
+                                               '(see prepare_backbone.py), by default models are converted whole')
+    parser.add_argument('--output', help='file to write the JSON results to, defaults to stdout')
+    args = parser.parse_args()
+    args.concurrency = [int(n) for n in args.concurrency.split(',') if n]
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    # Every request converts the same fixtures, so without this all but the first would be cache hits.
+    os.environ.setdefault('CONVERTER_CACHE_DIR', tempfile.mkdtemp())
+    if not args.cache:
+        os.environ['CONVERTER_CACHE_MAX_BYTES'] = '0'
+    # Likewise the results shouldn't depend on whichever extractors the working tree happens to hold.
+    if args.backbone_dir:
+        os.environ['BACKBONE_DIR'] = os.path.abspath(args.backbone_dir)
+    os.environ.setdefault('BACKBONE_DIR', tempfile.mkdtemp())
+
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Splices the head of an image model onto its separately converted feature extractor, float and uint8.
+
+Checks that both spliced models run on the TensorFlow version of the converter and agree with keras on the
+dataset images the quantized parts weren't calibrated on, e.g.
+
+    python test-splice.py image-model.zip image-model-data.zip --min-agreement 0.9
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks splicing an image model head onto its feature extractor.')
+    parser.add_argument('model', help='tfjs model zip exported by Teachable Machine')
+    parser.add_argument('dataset', help='dataset zip with one folder of images per class')
+    parser.add_argument('--min-agreement', type=float, default=0.9)
+    args = parser.parse_args()
+
+    # Nothing of the converter's own backbones is read or written.
+    os.environ['BACKBONE_DIR'] = tempfile.mkdtemp()
+    sys.path.insert(0, ROOT)
+    import numpy as np
+    import tensorflow as tf
+    import tensorflowjs as tfjs
+    from tmconverter.backends.backbone import split_backbone, splice_models
+    from tmconverter.backends.common import evaluate_tflite
+    from tmconverter.backends.image import convertKerasTFLiteQuantized, decode_image
+    from tmconverter.files import extract_model, list_dataset_images, open_upload_zip
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        with open(args.model, 'rb') as f:
+            extract_model(f, model_dir)
+        with open(model_dir + '/metadata.json') as f:
+            labels = json.load(f)['labels']
+        model = tfjs.converters.load_keras_model(model_dir + '/model.json')
+    parts = split_backbone(model)
+    if parts is None:
+        sys.exit('the model has no separate feature extractor')
+    backbone, head = parts
+    with open(args.dataset, 'rb') as f, open_upload_zip(f) as dataset_zip:
+        names = [name for files in list_dataset_images(dataset_zip, labels) for name in files]
+        data = np.stack([decode_image(dataset_zip.read(name)) for name in names])
+    # Every other image calibrates, the rest checks.
+    calibration, check = data[::2], data[1::2]
+    expected = np.argmax(model.predict(check), axis=1)
+
+    float_model = splice_models(tf.lite.TFLiteConverter.from_keras_model(backbone).convert(),
+                                tf.lite.TFLiteConverter.from_keras_model(head).convert())
+    quantized_model = splice_models(convertKerasTFLiteQuantized(backbone, calibration),
+                                    convertKerasTFLiteQuantized(head, backbone.predict(calibration)))
+    report = {'tensorflow': tf.__version__, 'images': len(check)}
+    for name, content in (('float', float_model), ('quantized', quantized_model)):
+        _, predictions = evaluate_tflite(content, check)
+        report[name] = float(np.mean(predictions == expected))
+    print(json.dumps(report, indent=2))
+
+    failures = ['{} agreement {:.3f} < {}'.format(name, report[name], args.min_agreement)
+                for name in ('float', 'quantized') if report[name] < args.min_agreement]
+    if failures:
+        sys.exit('splicing failed: ' + ', '.join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -28,8 +28,13 @@ else
   exit 1
 fi;
   
+ram_workspaces() {
+  curl --silent http://$HOST:$PORT/metrics | sed -n 's/^converter_workspaces_total{storage="ram"} //p'
+}
+
 # Test image keras
 echo "Test image keras conversion"
+ram_before=$(ram_workspaces)
 time curl -X POST \
   http://$HOST:$PORT/convert/image/keras \
   --silent \
@@ -45,6 +50,12 @@ else
     echo size is under $minimumsize bytes
     exit 1 
 fi
+# A model of a few MB is small enough to be converted in RAM
+ram_after=$(ram_workspaces)
+if [ "$ram_after" -le "$ram_before" ]; then
+  echo "keras conversion didn't run in a RAM workspace"
+  exit 1
+fi
 # Test image savedmodel
 echo "Test image savedmodel conversion"
 time curl -X POST \
@@ -62,6 +73,10 @@ else
     echo size is under $minimumsize bytes
     exit 1 
 fi
+# EDGETPU=false for converters without edgetpu_compiler, like the combined one
+if [ "$EDGETPU" != "false" ]; then
+  edgetpu_format=",edgetpu"
+  edgetpu_file="out/multi/model_edgetpu.tflite"
 # Test image edgetpu
 echo "Test image edgetpu conversion"
 time curl -X POST \
@@ -80,7 +95,78 @@ else
     echo size $actualsize is under $minimumsize bytes
     exit 1 
 fi
+fi
   
+# Test multi format conversion
+echo "Test image multi format conversion"
+time curl -X POST \
+  "http://$HOST:$PORT/convert/image?formats=keras,tflite,tflite_quantized${edgetpu_format}" \
+  --silent \
+  -H 'cache-control: no-cache' \
+  -H 'content-type: multipart/form-data; boundary=----WebKitFormBoundary7MA4YWxkTrZu0gW' \
+  -F model=@./image-model.zip \
+  -F dataset=@./image-model-data.zip > out/multi.zip
+unzip -o out/multi.zip -d out/multi
+for file in out/multi/keras_model.h5 out/multi/model_unquant.tflite out/multi/model.tflite $edgetpu_file out/multi/labels.txt out/multi/report.json; do
+  if [ ! -f "$file" ]; then
+    echo "$file missing from multi format zip"
+    exit 1
+  fi
+done
+# The quantization report has the documented keys
+python -c "import json, sys; report = json.load(open(sys.argv[1])); missing = [key for key in ('top1_agreement', 'calibration') if key not in report] + ([] if 'model_bytes' in report.get('float', {}) else ['float.model_bytes']); sys.exit('report.json lacks ' + ', '.join(missing) if missing else None)" out/multi/report.json
+# Validate the uint8 quantized model against the original model over the whole dataset
+echo "Validate image quantized tflite conversion"
+python ../../validate-tflite.py out/multi/model.tflite ./image-model-data.zip --keras ./image-model.zip \
+  --labels out/multi/labels.txt --min-agreement 0.9 --output out/validation-quantized.json
+
+# Test job api
+echo "Test image conversion job"
+job_id=$(curl -X POST \
+  "http://$HOST:$PORT/jobs?type=image&format=tflite" \
+  --silent \
+  -F model=@./image-model.zip | python -c "import json, sys; print(json.load(sys.stdin)['id'])")
+for i in $(seq 1 60); do
+  stage=$(curl --silent http://$HOST:$PORT/jobs/$job_id | python -c "import json, sys; print(json.load(sys.stdin)['stage'])")
+  if [ "$stage" == "done" ] || [ "$stage" == "failed" ]; then
+    break
+  fi
+  sleep 5
+done
+if [ "$stage" != "done" ]; then
+  echo "Job ended in stage $stage"
+  exit 1
+fi
+curl --silent http://$HOST:$PORT/jobs/$job_id/result > out/job.zip
+unzip -o out/job.zip -d out/job
+if [ ! -f out/job/model_unquant.tflite ]; then
+  echo "model_unquant.tflite missing from job result"
+  exit 1
+fi
+
+# Test batch api with one valid and one broken model
+echo "Test image batch conversion"
+mkdir -p out/batch-upload/good out/batch-upload/broken
+cp ./image-model.zip out/batch-upload/good/model.zip
+echo "not a zip" > out/batch-upload/broken/model.zip
+python -c "import shutil; shutil.make_archive('out/batch', 'zip', 'out/batch-upload')"
+time curl -X POST \
+  "http://$HOST:$PORT/batch/image?formats=keras" \
+  --silent \
+  -F models=@./out/batch.zip > out/batch-result.zip
+unzip -o out/batch-result.zip -d out/batch-result
+for file in out/batch-result/good/keras_model.h5 out/batch-result/good/labels.txt out/batch-result/status.json; do
+  if [ ! -f "$file" ]; then
+    echo "$file missing from batch result"
+    exit 1
+  fi
+done
+stages=$(python -c "import json; print(' '.join(item['name'] + '=' + item['stage'] for item in json.load(open('out/batch-result/status.json'))))")
+if [ "$stages" != "broken=failed good=done" ]; then
+  echo "Batch ended in stages $stages"
+  exit 1
+fi
+
 # Test image tflite
 echo "Test image tflite conversion"
 time curl -X POST \
@@ -100,3 +186,12 @@ test_response=$(python test-image-tflite.py ${model} ./image-model-data.zip "Cla
 if [ '1' != "${test_response}" ]; then
   exit 1
 fi;
+
+# Validate the unquantized tflite model against the original model over the whole dataset
+echo "Validate image tflite conversion"
+python ../../validate-tflite.py ${model} ./image-model-data.zip --keras ./image-model.zip --labels out/labels.txt \
+  --min-agreement 0.95 --output out/validation.json
+
+# Splice the head onto the separately converted feature extractor, which converters only do with a bundled backbone
+echo "Test image backbone splicing"
+python test-splice.py ./image-model.zip ./image-model-data.zip --min-agreement 0.9
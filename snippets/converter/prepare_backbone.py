@@ -0,0 +1,73 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Quantizes the feature extractor of a Teachable Machine image model for the image converter to splice heads onto.
+
+Run when building the image, with a model built on the standard extractor and a zip of calibration images, e.g.
+
+    python prepare_backbone.py image/test/image-model.zip everyday-photos.zip --output backbones
+
+Only the extractors prepared this way are spliced, every other model is converted whole.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import zipfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+
+
+def list_images(calibration_zip):
+    # Every image in the zip, whatever folder it is in, without the macOS resource forks.
+    return sorted(name for name in calibration_zip.namelist()
+                  if name.lower().endswith(IMAGE_EXTENSIONS) and not name.startswith('__MACOSX'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Quantizes the feature extractor of an image model at build time.')
+    parser.add_argument('model', help='tfjs model zip exported by Teachable Machine')
+    parser.add_argument('calibration', help='zip of the images the extractor is calibrated on')
+    parser.add_argument('--output', default='backbones', help='folder the converter reads as BACKBONE_DIR')
+    args = parser.parse_args()
+
+    # The backbone module reads its folder at import.
+    os.environ['BACKBONE_DIR'] = os.path.abspath(args.output)
+    sys.path.insert(0, ROOT)
+    import numpy as np
+    import tensorflowjs as tfjs
+    from tmconverter.backends.backbone import backbone_key, split_backbone, store_backbone
+    from tmconverter.backends.image import convertKerasTFLiteQuantized, decode_image
+    from tmconverter.files import extract_model
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        with open(args.model, 'rb') as f:
+            extract_model(f, model_dir)
+        model = tfjs.converters.load_keras_model(model_dir + '/model.json')
+    parts = split_backbone(model)
+    if parts is None:
+        sys.exit('the model has no separate feature extractor')
+    with zipfile.ZipFile(args.calibration) as calibration_zip:
+        names = list_images(calibration_zip)
+        if not names:
+            sys.exit('no images in ' + args.calibration)
+        data = np.stack([decode_image(calibration_zip.read(name)) for name in names])
+    key = backbone_key(parts[0], 'uint8')
+    store_backbone(key, convertKerasTFLiteQuantized(parts[0], data))
+    print('quantized backbone {} on {} images'.format(key, len(names)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
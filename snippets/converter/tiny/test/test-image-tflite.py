@@ -25,7 +25,7 @@ with zipfile.ZipFile(sys.argv[2], 'r') as zip_ref:
 
     img = load_img(os.path.join(dirpath, sys.argv[3]))
     img_array = img_to_array(img)
-    img_array = (img_array.astype(np.float32) / 127.0) - 1
+    img_array = (img_array.astype(np.float32) / 127.5) - 1
 
     # Set the tensor
     interpreter.set_tensor(
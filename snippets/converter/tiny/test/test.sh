@@ -48,6 +48,12 @@ else
     echo size $actualsize is under $minimumsize bytes
     exit 1 
 fi
+# The quantization report has the documented keys
+if [ ! -f out/sketch/report.json ]; then
+  echo "report.json missing from tinyml zip"
+  exit 1
+fi
+python -c "import json, sys; report = json.load(open(sys.argv[1])); missing = [key for key in ('top1_agreement', 'calibration') if key not in report] + ([] if 'model_bytes' in report.get('float', {}) else ['float.model_bytes']); sys.exit('report.json lacks ' + ', '.join(missing) if missing else None)" out/sketch/report.json
 # echo "Test sucessful"
 
 echo "Test image tflite conversion"
@@ -68,4 +74,8 @@ else
     echo size $actualsize is under $minimumsize bytes
     exit 1 
 fi
+# Validate the quantized tflite model against the original model over the whole dataset
+echo "Validate image tflite conversion"
+python ../../validate-tflite.py out/sketch/vww_96_grayscale_quantized.tflite ./image-model-data.zip \
+  --keras ./tiny-image-model.zip --labels out/sketch/labels.txt --min-agreement 0.9 --output out/validation.json
 echo "Test sucessful"
\ No newline at end of file
@@ -0,0 +1,20 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Shared core of the Teachable Machine model converters.
+
+The HTTP endpoints, uploads, result zips, cache, jobs and metrics live here once. The TensorFlow work is done by
+one backend per model type in `tmconverter.backends`, imported the first time its type is needed.
+"""
+
+from tmconverter.app import create_app
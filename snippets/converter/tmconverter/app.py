@@ -0,0 +1,260 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+import asyncio
+import os
+import threading
+import time
+
+from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse
+
+from tmconverter import jobs as job_state
+from tmconverter.backends import BACKENDS, SPECS, backend_future, loaded
+from tmconverter.batch import batch_response, cleanup_batch, extract_bundles, start_batch
+from tmconverter.cache import cache_lookup, hash_uploads, link_cached
+from tmconverter.files import open_upload_zip, save_upload, upload_size
+from tmconverter.jobs import CONVERSION_WORKERS, ConversionJob, executor, expire_jobs, jobs, run_conversion, run_job
+from tmconverter.metrics import format_metrics
+from tmconverter.results import add_timing_report, cached_response, zip_response
+from tmconverter.workspace import WORKSPACE_SWEEP_SECONDS, open_workspace, sweep_workspaces, workspace_usage
+
+def env_list(name, default):
+    return [item for item in os.environ.get(name, ','.join(default)).split(',') if item]
+
+def conversion_cache_key(spec, formats, model, dataset):
+    ordered_formats = [format for format in spec.formats if format in formats]
+    return hash_uploads(spec.type, ','.join(ordered_formats), model,
+                        dataset if spec.needs_dataset(formats) else None)
+
+def create_app(types=None):
+    """Builds the converter app for the given model types, CONVERTER_BACKENDS (default all of them) if None.
+
+    Nothing heavy is imported here, so the server answers right away. The backends in WARMUP_BACKENDS (default all
+    served ones) start loading in the background at startup and are then warmed up, the others load on the first
+    request for their type. Requests wait for their backend to load, not for the warm-up.
+    """
+    types = types or env_list('CONVERTER_BACKENDS', BACKENDS)
+    warmup_types = [type for type in env_list('WARMUP_BACKENDS', types) if type in types]
+    warmed_up = threading.Event()
+
+    app = FastAPI()
+    app.add_middleware(
+        CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]
+    )
+
+    def warm_up():
+        for type in warmup_types:
+            try:
+                backend_future(type).result().warm_up()
+            except Exception as e:
+                print('warm up of '+type+' failed: '+str(e), flush=True)
+        warmed_up.set()
+
+    def sweep():
+        # The first sweep reclaims what a crashed worker left behind, the later ones whatever leaked since.
+        while True:
+            try:
+                expire_jobs()
+                sweep_workspaces()
+            except Exception as e:
+                print('workspace sweep failed: '+str(e), flush=True)
+            time.sleep(WORKSPACE_SWEEP_SECONDS)
+
+    def get_spec(type):
+        if type not in types:
+            raise HTTPException(status_code=403, detail="bad request format")
+        return SPECS[type]
+
+    async def get_backend(type):
+        get_spec(type)
+        return await asyncio.wrap_future(backend_future(type))
+
+    async def handle_conversion(type, formats, background_tasks, model, dataset, timing):
+        # Requests are checked and looked up in the cache before waiting for the backend, a hit never loads it.
+        spec = get_spec(type)
+        error = spec.validate(formats, dataset)
+        if error:
+            return error
+        # Hashing reads the whole upload, which would hold up every other request on the event loop.
+        cache_key = await run_in_threadpool(conversion_cache_key, spec, formats, model, dataset)
+        cached_path = cache_lookup(cache_key)
+        response = cached_response(cached_path, spec.result_filename(formats)) if cached_path else None
+        if response:
+            print("### CACHE HIT "+cache_key, flush=True)
+            return response
+        backend = await get_backend(type)
+        job = backend.create_job(formats, open_workspace(upload_size(model) + upload_size(dataset)))
+        conversion = executor.submit(run_conversion, backend, job, model.file, dataset.file if dataset else None)
+        try:
+            entries = await asyncio.wrap_future(conversion)
+        except Exception:
+            # Also reached when the client goes away, the files are only removed once the conversion stops using them.
+            conversion.add_done_callback(lambda conversion: job.release())
+            raise
+        background_tasks.add_task(job.release)
+        if timing:
+            # The timing report differs between runs, so a zip that includes it is not cached.
+            return zip_response(add_timing_report(job, entries), backend.result_filename(formats), None, job.timings)
+        return zip_response(entries, backend.result_filename(formats), cache_key, job.timings)
+
+    async def cached_job(spec, formats, cached_path):
+        """A finished job with its own link to the cached result, None if the entry was evicted in the meantime."""
+        try:
+            # A cached result needs no room to convert in, only for the job's copy of the zip.
+            workspace = open_workspace(os.path.getsize(cached_path), growth=1)
+        except FileNotFoundError:
+            return None
+        job = ConversionJob(spec.type, formats, [], workspace)
+        try:
+            job.result_path = await run_in_threadpool(link_cached, cached_path, job.data_dir + '/result.zip')
+        except FileNotFoundError:
+            job.release()
+            return None
+        except Exception:
+            job.release()
+            raise
+        job.result_filename = spec.result_filename(formats)
+        job.set_stage('done')
+        job.finished_at = time.time()
+        jobs[job.id] = job
+        return job
+
+    @app.on_event("startup")
+    async def start_warm_up():
+        for type in warmup_types:
+            backend_future(type)
+        threading.Thread(target=warm_up, daemon=True).start()
+        threading.Thread(target=sweep, daemon=True).start()
+
+    @app.get("/keep_warm")
+    async def keep_warm():
+        return "ok"
+
+    @app.get("/metrics")
+    async def metrics():
+        return PlainTextResponse(format_metrics(job_state.activeJobs, workspace_usage()),
+                                 media_type='text/plain; version=0.0.4')
+
+    @app.get("/ready")
+    async def ready():
+        """Readiness for the autoscaler: 200 only if a conversion can start right away."""
+        activeJobs = job_state.activeJobs
+        if not warmed_up.is_set():
+            state = 'warming'
+        elif activeJobs >= CONVERSION_WORKERS:
+            state = 'busy'
+        elif activeJobs:
+            state = 'warm'
+        else:
+            state = 'idle'
+        content = {'state': state, 'activeJobs': activeJobs, 'workers': CONVERSION_WORKERS,
+                   'backends': sorted(type for type in loaded if type in types)}
+        return JSONResponse(content, status_code=200 if state in ('warm', 'idle') else 503)
+
+    @app.post("/convert/{type}/{format}")
+    async def create_upload_file(type: str, format: str, background_tasks: BackgroundTasks,  model: UploadFile = File(...), dataset: UploadFile = File(default=None), timing: bool = False):
+
+        print("uploading", flush=True)
+        return await handle_conversion(type, {format}, background_tasks, model, dataset, timing)
+
+    @app.post("/convert/{type}")
+    async def create_upload_files(type: str, formats: str, background_tasks: BackgroundTasks,  model: UploadFile = File(...), dataset: UploadFile = File(default=None), timing: bool = False):
+        """Converts the model once into every format in the comma separated `formats` query and returns them in one zip."""
+
+        print("uploading", flush=True)
+        return await handle_conversion(type, set(formats.split(',')), background_tasks, model, dataset, timing)
+
+    @app.post("/batch/{type}")
+    async def convert_batch(type: str, formats: str, background_tasks: BackgroundTasks, models: UploadFile = File(...)):
+        """Converts every `<name>/model.zip` (with its `<name>/dataset.zip`) in the uploaded zip into `formats`.
+
+        The results are streamed back under `<name>/` as each model finishes, followed by a status.json with the
+        stage and error of every model, so one failing model doesn't fail the batch.
+        """
+
+        print("uploading", flush=True)
+        backend = await get_backend(type)
+        # Only holds the extracted bundles, each model gets its own workspace.
+        workspace = open_workspace(upload_size(models), growth=1)
+        try:
+            with open_upload_zip(models.file) as batch_zip:
+                bundles = await asyncio.get_event_loop().run_in_executor(
+                    None, extract_bundles, batch_zip, workspace.data_dir)
+            items = start_batch(backend, set(formats.split(',')), bundles)
+        except Exception:
+            workspace.release()
+            raise
+        background_tasks.add_task(cleanup_batch, items, workspace)
+        return batch_response(items, workspace.data_dir)
+
+    @app.post("/jobs")
+    async def create_job(type: str, format: str, model: UploadFile = File(...), dataset: UploadFile = File(default=None)):
+        """Queues a conversion and returns its id right away, `format` may list several formats separated by commas."""
+
+        print("uploading", flush=True)
+        formats = set(format.split(','))
+        spec = get_spec(type)
+        error = spec.validate(formats, dataset)
+        if error:
+            return error
+        expire_jobs()
+        cache_key = await run_in_threadpool(conversion_cache_key, spec, formats, model, dataset)
+        cached_path = cache_lookup(cache_key)
+        if cached_path:
+            job = await cached_job(spec, formats, cached_path)
+            if job:
+                print("### CACHE HIT "+cache_key, flush=True)
+                return job.status()
+        backend = await get_backend(type)
+        workspace = open_workspace(upload_size(model) + upload_size(dataset))
+        job = backend.create_job(formats, workspace)
+        job.result_filename = backend.result_filename(formats)
+        jobs[job.id] = job
+        # The uploads are copied into the job dir, the request's own files are gone by the time a worker picks the job up.
+        try:
+            model_path = await run_in_threadpool(save_upload, model, job.data_dir + '/upload_model.zip')
+            dataset_path = (await run_in_threadpool(save_upload, dataset, job.data_dir + '/upload_dataset.zip')
+                            if dataset else None)
+        except Exception:
+            jobs.pop(job.id, None)
+            job.release()
+            raise
+        job.cache_key = cache_key
+        executor.submit(run_job, backend, job, model_path, dataset_path)
+        return job.status()
+
+    @app.get("/jobs/{job_id}")
+    async def get_job(job_id: str):
+        if job_id not in jobs:
+            raise HTTPException(status_code=404, detail="job not found")
+        return jobs[job_id].status()
+
+    @app.get("/jobs/{job_id}/result")
+    async def get_job_result(job_id: str, background_tasks: BackgroundTasks):
+        if job_id not in jobs:
+            raise HTTPException(status_code=404, detail="job not found")
+        job = jobs[job_id]
+        if job.stage == 'failed':
+            raise HTTPException(status_code=500, detail=job.error)
+        if job.stage != 'done':
+            raise HTTPException(status_code=409, detail="job not finished")
+        jobs.pop(job_id, None)
+        background_tasks.add_task(job.release)
+        if job.result_path:
+            return FileResponse(job.result_path, media_type='application/octet-stream', filename=job.result_filename)
+        return zip_response(job.result_entries, job.result_filename, job.cache_key, job.timings)
+
+    return app
@@ -0,0 +1,89 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Per model type converters.
+
+Every model type has a spec in `specs`, which doesn't import TensorFlow, with:
+    type                           the model type in the url
+    formats                        the formats it converts to, in the order they are produced
+    validate(formats, dataset)     None, or the error to answer the request with
+    needs_dataset(formats)         whether the dataset changes the result, for the cache key
+    result_filename(formats)       name of the returned zip
+
+Every backend module defines a `Backend` class extending its type's spec with:
+    create_job(formats, workspace) a ConversionJob with the stages the formats go through, in the given workspace
+    convert(job, model, dataset)   converts the uploaded files, returns the zip entries
+    warm_up()                      converts a small built-in model at startup
+"""
+
+import importlib
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tmconverter.backends.specs import SPECS
+from tmconverter.metrics import record_import
+
+# Backends import TensorFlow, so each one is only imported the first time its type is used.
+BACKENDS = {
+    'image': 'tmconverter.backends.image',
+    'tiny_image': 'tmconverter.backends.tiny',
+    'audio': 'tmconverter.backends.audio',
+}
+# Heavy modules imported one by one ahead of each backend, so their import time is measured on its own.
+DEPENDENCIES = {
+    'image': ['numpy', 'PIL.Image', 'tensorflow', 'tensorflowjs'],
+    'tiny_image': ['numpy', 'PIL.Image', 'tensorflow', 'tensorflowjs'],
+    'audio': ['numpy', 'tensorflow', 'tensorflowjs', 'tflite_support.metadata_writers.audio_classifier'],
+}
+loaded = {}
+# Future of every backend that is loading or loaded, resolving to its Backend.
+futures = {}
+# Reentrant, the done callback runs right away under the lock if the import already failed.
+futures_lock = threading.RLock()
+# Imports run one at a time on their own thread, so they never hold up the event loop or a conversion worker.
+loader = ThreadPoolExecutor(max_workers=1)
+
+def timed_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.time()
+    module = importlib.import_module(name)
+    record_import(name, time.time() - start)
+    return module
+
+def import_backend(type):
+    for name in DEPENDENCIES[type]:
+        timed_import(name)
+    # The backend's own import time includes whatever it loads at import, like the audio preproc model.
+    loaded[type] = timed_import(BACKENDS[type]).Backend()
+    return loaded[type]
+
+def forget_failed(type, future):
+    # A backend that failed to import is retried by the next request for its type.
+    if future.exception() is not None:
+        with futures_lock:
+            if futures.get(type) is future:
+                del futures[type]
+
+def backend_future(type):
+    """Starts loading the backend in the background if it isn't yet, and returns the future it resolves."""
+    with futures_lock:
+        if type not in futures:
+            future = futures[type] = loader.submit(import_backend, type)
+            future.add_done_callback(lambda future: forget_failed(type, future))
+        return futures[type]
+
+def load_backend(type):
+    return backend_future(type).result()
@@ -0,0 +1,152 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Audio models: tflite with the speech commands preprocessing and classifier metadata."""
+
+import os
+
+import numpy as np
+import tensorflow as tf
+from tflite_support.metadata_writers import audio_classifier
+from tflite_support.metadata_writers import writer_utils
+
+from tmconverter.backends.backbone import splice_models
+from tmconverter.backends.common import load_tfjs_model, warmup_formats
+from tmconverter.backends.specs import AUDIO_FORMATS, AudioSpec
+from tmconverter.files import returnFiles, write_labels
+from tmconverter.jobs import ConversionJob
+
+AudioClassifierWriter = audio_classifier.MetadataWriter
+
+# load preproc layers
+preproc_model_path = os.environ.get('PREPROC_MODEL_PATH', 'sc_preproc_model')
+preproc_model = tf.keras.models.load_model(preproc_model_path)
+input_length = preproc_model.input_shape[-1]
+# The preproc front end never changes, so it is traced once here. Conversions that can't splice call this concrete
+# function and only trace the uploaded classifier head on top of it.
+preproc_function = tf.function(preproc_model).get_concrete_function(
+    tf.TensorSpec([None, input_length], preproc_model.inputs[0].dtype))
+WARMUP_FORMATS = warmup_formats(AUDIO_FORMATS, AUDIO_FORMATS)
+# The spliced model has to give the same class probabilities as the keras model on a fixed random waveform, up to
+# this much. The tflite FFT doesn't match TensorFlow's bit for bit, so neither does the whole converted model.
+SPLICE_TOLERANCE = 1e-3
+CHECK_WAVEFORM = np.random.RandomState(0).uniform(-1.0, 1.0, (1, input_length)).astype(np.float32)
+CHECK_FEATURES = preproc_model(CHECK_WAVEFORM)
+
+def convert_preproc():
+    try:
+        return tf.lite.TFLiteConverter.from_concrete_functions([preproc_function]).convert()
+    except Exception as e:
+        print('converting the preproc model failed, converting every model whole: '+str(e), flush=True)
+        return None
+
+# The preproc front end converted to tflite once, each conversion only converts the classifier head and splices it
+# on. None once splicing itself failed, every model is then converted whole with the preproc in front.
+preproc_tflite = convert_preproc()
+
+def run_spliced(spliced_model):
+    interpreter = tf.lite.Interpreter(model_content=spliced_model)
+    interpreter.allocate_tensors()
+    interpreter.set_tensor(interpreter.get_input_details()[0]['index'], CHECK_WAVEFORM)
+    interpreter.invoke()
+    return interpreter.get_tensor(interpreter.get_output_details()[0]['index'])
+
+def convert_spliced(model):
+    """Converts only the head and splices it onto the converted preproc model, None if that isn't possible.
+
+    A head that doesn't convert or check out on its own only falls back for this model, splicing that raises turns
+    it off for every later one.
+    """
+    global preproc_tflite
+    if preproc_tflite is None:
+        return None
+    try:
+        head = tf.lite.TFLiteConverter.from_keras_model(model).convert()
+    except Exception as e:
+        print('converting the head on its own failed, converting the whole model: '+str(e), flush=True)
+        return None
+    try:
+        spliced_model = splice_models(preproc_tflite, head)
+    except Exception as e:
+        print('splicing onto the preproc model failed, converting every model whole: '+str(e), flush=True)
+        preproc_tflite = None
+        return None
+    try:
+        output = run_spliced(spliced_model)
+        expected = model(CHECK_FEATURES, training=False).numpy()
+    except Exception as e:
+        print('the spliced model failed to run, converting the whole model: '+str(e), flush=True)
+        return None
+    if not np.allclose(output, expected, atol=SPLICE_TOLERANCE):
+        print('the spliced model differs from keras by {}, converting the whole model'.format(
+            np.max(np.abs(output - expected))), flush=True)
+        return None
+    return spliced_model
+
+def combined_function(model):
+    # Calling the cached concrete function embeds the traced preproc graph as is, no keras model is rebuilt.
+    @tf.function(input_signature=preproc_function.structured_input_signature[0])
+    def combined_model(waveform):
+        return model(preproc_function(waveform), training=False)
+    return combined_model.get_concrete_function()
+
+def convert_keras_model(job, model):
+    model_dir = job.model_dir
+    labels_path = model_dir + '/labels.txt'
+    # save the model as a tflite file
+    tflite_output_path = model_dir + '/soundclassifier.tflite'
+    job.set_stage('tflite')
+    tflite_model = convert_spliced(model)
+    if tflite_model is None:
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([combined_function(model)])
+        tflite_model = converter.convert()
+    with open(tflite_output_path, 'wb') as f:
+        f.write(tflite_model)
+
+    # add metadata to model
+    job.set_stage('metadata')
+    save_to_path = model_dir + '/soundclassifier_with_metadata.tflite'
+    channels = 1
+    tm_sample_rate = 44100
+    writer = AudioClassifierWriter.create_for_inference(writer_utils.load_file(tflite_output_path),
+                                                        tm_sample_rate, channels, [labels_path])
+    writer_utils.save_file(writer.populate(), save_to_path)
+    return returnFiles(['soundclassifier_with_metadata.tflite'], model_dir)
+
+class Backend(AudioSpec):
+    def create_job(self, formats, workspace=None):
+        return ConversionJob('audio', formats, ['unzip', 'keras', 'tflite', 'metadata'], workspace)
+
+    def convert(self, job, model, dataset):
+        return convert_keras_model(job, load_tfjs_model(job, model, 'wordLabels'))
+
+    def warm_up(self):
+        """Converts a tiny built-in head on top of the preproc model, so the first real request finds the converter initialized."""
+        if not WARMUP_FORMATS:
+            return
+        job = self.create_job({'tflite'})
+        job.warmup = True
+        try:
+            print('warming up', flush=True)
+            job.labels = ['Background Noise', 'Class 2']
+            write_labels(job.model_dir, job.labels)
+            model = tf.keras.Sequential([
+                tf.keras.layers.Flatten(input_shape=preproc_model.output_shape[1:]),
+                tf.keras.layers.Dense(len(job.labels), activation='softmax'),
+            ])
+            convert_keras_model(job, model)
+            print('warm up done', flush=True)
+        except Exception as e:
+            print('warm up failed: '+str(e), flush=True)
+        finally:
+            job.release()
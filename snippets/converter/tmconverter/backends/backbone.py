@@ -0,0 +1,152 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Quantized feature extractors shared by many uploaded models, and splicing a quantized head onto them."""
+
+import hashlib
+import os
+import tempfile
+import threading
+
+import tensorflow as tf
+
+# Models built on one of the feature extractors quantized into BACKBONE_DIR at build time (see prepare_backbone.py)
+# only convert their head and splice it onto the bundled extractor. Any other model is converted whole, set
+# BACKBONE_SPLICE=false to always convert the whole model.
+BACKBONE_SPLICE = os.environ.get('BACKBONE_SPLICE', 'true').lower() != 'false'
+BACKBONE_DIR = os.environ.get('BACKBONE_DIR', 'backbones')
+# Quantized extractors read so far, by key. Only bundled ones are ever read, so this holds at most one per file.
+backbones = {}
+backbones_lock = threading.Lock()
+# Extractors splicing raised an error for, e.g. on a TensorFlow without the flatbuffers object API. Models built on
+# them are converted whole from then on, without first paying for the float extractor and the head.
+failed_backbones = set()
+
+def bundled_backbones():
+    if not os.path.isdir(BACKBONE_DIR):
+        return set()
+    return {name[:-len('.tflite')] for name in os.listdir(BACKBONE_DIR) if name.endswith('.tflite')}
+
+# The allowlist of extractors that get spliced.
+BACKBONE_KEYS = bundled_backbones()
+
+def split_backbone(model):
+    """(feature extractor, head) if the model is the two nested models Teachable Machine exports, else None."""
+    layers = getattr(model, 'layers', [])
+    if len(layers) != 2 or not all(isinstance(layer, tf.keras.Model) for layer in layers):
+        return None
+    return layers[0], layers[1]
+
+def backbone_key(backbone, input_type):
+    # Layer names change between loads, the shapes and values of the weights don't.
+    digest = hashlib.sha256(input_type.encode())
+    for weights in backbone.get_weights():
+        digest.update(str(weights.shape).encode())
+        digest.update(weights.tobytes())
+    return digest.hexdigest()
+
+def cached_backbone(key):
+    """The bundled quantized extractor with this key, None if it isn't one of the bundled ones or failed to splice."""
+    if key not in BACKBONE_KEYS or key in failed_backbones:
+        return None
+    with backbones_lock:
+        if key in backbones:
+            return backbones[key]
+    with open(os.path.join(BACKBONE_DIR, key + '.tflite'), 'rb') as f:
+        content = f.read()
+    with backbones_lock:
+        backbones[key] = content
+    return content
+
+def forget_backbone(key):
+    with backbones_lock:
+        failed_backbones.add(key)
+        backbones.pop(key, None)
+
+def store_backbone(key, content):
+    # Only run at build time, the converter itself never adds extractors.
+    os.makedirs(BACKBONE_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=BACKBONE_DIR, suffix='.tmp', delete=False) as f:
+        f.write(content)
+    os.replace(f.name, os.path.join(BACKBONE_DIR, key + '.tflite'))
+
+def operator_code_key(code):
+    return (code.builtinCode, getattr(code, 'deprecatedBuiltinCode', None), code.customCode, code.version)
+
+def splice_models(backbone_content, head_content):
+    """Appends the head's graph to the backbone's, feeding the backbone output to the ops reading the head's input.
+
+    Either both models are float, or both are fully quantized with uint8 input and output. A quantized head's first
+    op requantizes its uint8 input to int8, taking the backbone's uint8 output instead also carries over the
+    backbone's scale.
+    """
+    # Only needed here, and older TensorFlow versions come without the object API or flatbuffers.
+    import flatbuffers
+    from tensorflow.lite.python import schema_py_generated as schema_fb
+
+    backbone = schema_fb.ModelT.InitFromObj(schema_fb.Model.GetRootAsModel(backbone_content, 0))
+    head = schema_fb.ModelT.InitFromObj(schema_fb.Model.GetRootAsModel(head_content, 0))
+    if len(backbone.subgraphs) != 1 or len(head.subgraphs) != 1:
+        raise ValueError('only single subgraph models can be spliced')
+    graph = backbone.subgraphs[0]
+    head_graph = head.subgraphs[0]
+
+    opcodes = [operator_code_key(code) for code in backbone.operatorCodes]
+    opcode_map = []
+    for code in head.operatorCodes:
+        if operator_code_key(code) not in opcodes:
+            opcodes.append(operator_code_key(code))
+            backbone.operatorCodes.append(code)
+        opcode_map.append(opcodes.index(operator_code_key(code)))
+
+    buffer_offset = len(backbone.buffers)
+    backbone.buffers.extend(head.buffers)
+    tensor_offset = len(graph.tensors)
+    for tensor in head_graph.tensors:
+        tensor.buffer += buffer_offset
+        tensor.name = (b'head/' if isinstance(tensor.name, bytes) else 'head/') + tensor.name
+        graph.tensors.append(tensor)
+
+    def shift(indices):
+        # -1 marks an omitted optional input.
+        return [index + tensor_offset if index >= 0 else index for index in indices] if indices is not None else None
+
+    head_input = head_graph.inputs[0] + tensor_offset
+    if graph.tensors[head_input].type != graph.tensors[graph.outputs[0]].type:
+        raise ValueError('the backbone output and the head input have different types')
+    quantized = graph.tensors[head_input].type != schema_fb.TensorType.FLOAT32
+    quantize_opcodes = {opcode_map[index] for index, code in enumerate(head.operatorCodes)
+                        if code.builtinCode == schema_fb.BuiltinOperator.QUANTIZE}
+    rewired = 0
+    for op in head_graph.operators:
+        op.opcodeIndex = opcode_map[op.opcodeIndex]
+        op.inputs = shift(op.inputs)
+        op.outputs = shift(op.outputs)
+        op.intermediates = shift(op.intermediates)
+        if head_input in op.inputs:
+            if quantized and op.opcodeIndex not in quantize_opcodes:
+                raise ValueError('the head input is not quantized by its first op')
+            op.inputs = [graph.outputs[0] if index == head_input else index for index in op.inputs]
+            rewired += 1
+        graph.operators.append(op)
+    if not rewired:
+        raise ValueError('the head input is not used')
+
+    graph.outputs = shift(head_graph.outputs)
+    # Signatures point at the backbone's own output, which isn't the model output anymore.
+    if hasattr(backbone, 'signatureDefs'):
+        backbone.signatureDefs = None
+
+    builder = flatbuffers.Builder(1024)
+    builder.Finish(backbone.Pack(builder), file_identifier=b'TFL3')
+    return bytes(builder.Output())
@@ -0,0 +1,186 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""TensorFlow helpers shared by the backends."""
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+import tensorflowjs as tfjs
+
+from tmconverter.files import extract_model, list_dataset_images, write_labels
+
+decode_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+# Calibration uses at most this many images per class, 0 leaves it to the backend.
+CALIBRATION_MAX_PER_CLASS = int(os.environ.get('CALIBRATION_MAX_PER_CLASS', 0))
+# Quantized conversions get a report.json comparing the quantized and float models on dataset images held out of calibration.
+QUANTIZATION_REPORT = os.environ.get('QUANTIZATION_REPORT', 'true').lower() != 'false'
+REPORT_HOLDOUT_FRACTION = float(os.environ.get('REPORT_HOLDOUT_FRACTION', 0.1))
+REPORT_MAX_IMAGES = int(os.environ.get('REPORT_MAX_IMAGES', 100))
+# Calibration stops once no activation range moved by more than CALIBRATION_TOLERANCE of its width for
+# CALIBRATION_PATIENCE batches in a row, after at least CALIBRATION_MIN_SAMPLES samples. 0 calibrates on every sample.
+CALIBRATION_TOLERANCE = float(os.environ.get('CALIBRATION_TOLERANCE', 0.01))
+CALIBRATION_MIN_SAMPLES = int(os.environ.get('CALIBRATION_MIN_SAMPLES', 100))
+CALIBRATION_PATIENCE = 3
+# Small batches, the probe returns the activations of every layer at once.
+CALIBRATION_PROBE_BATCH = 8
+
+def warmup_formats(formats, default):
+    # WARMUP_FORMATS is shared by every backend of the process, each one warms up the formats it knows.
+    names = os.environ.get('WARMUP_FORMATS', ','.join(default)).split(',')
+    return [format for format in names if format in formats]
+
+def load_tfjs_model(job, model, labels_key='labels'):
+    """Extracts the uploaded tfjs model, writes labels.txt and loads the model into keras."""
+    model_dir = job.model_dir
+    job.set_stage('unzip')
+    extract_model(model, model_dir)
+    with open(model_dir + '/metadata.json') as json_file:
+        data = json.load(json_file)
+    job.labels = data[labels_key]
+
+    print("Generating lables.txt")
+    write_labels(model_dir, job.labels)
+    print('Labels:'+', '.join(job.labels), flush=True)
+
+    # Load the tfjs model in-process, backends only write the h5 file when keras output was requested.
+    job.set_stage('keras')
+    print('converting model to keras', flush=True)
+    return tfjs.converters.load_keras_model(model_dir + '/model.json')
+
+def activation_probes(model):
+    """Keras models returning every layer's activations, each one fed the last output of the one before."""
+    # The layers of nested models, like the feature extractor and head of Teachable Machine models, aren't
+    # reachable from the outer model's inputs, so every nested model gets its own probe.
+    parts = model.layers if model.layers and all(isinstance(layer, tf.keras.Model) for layer in model.layers) else [model]
+    probes = []
+    for part in parts:
+        outputs = [tensor for layer in part.layers if not isinstance(layer, tf.keras.layers.InputLayer)
+                   for tensor in tf.nest.flatten(layer.output)]
+        probes.append(tf.keras.Model(part.inputs, outputs + [part.outputs[0]]))
+    return probes
+
+class RangeTracker:
+    """Running min/max of every activation of the model over the calibration samples seen so far."""
+    def __init__(self, model):
+        self.probes = activation_probes(model)
+        self.mins = None
+        self.maxs = None
+        self.samples = 0
+        self.stable_batches = 0
+
+    def update(self, batch):
+        values = []
+        inputs = batch
+        for probe in self.probes:
+            outputs = probe.predict_on_batch(inputs)
+            outputs = outputs if isinstance(outputs, list) else [outputs]
+            values.extend(outputs[:-1])
+            inputs = outputs[-1]
+        mins = np.array([np.min(value) for value in values])
+        maxs = np.array([np.max(value) for value in values])
+        if self.mins is None:
+            self.mins, self.maxs = mins, maxs
+        else:
+            new_mins, new_maxs = np.minimum(self.mins, mins), np.maximum(self.maxs, maxs)
+            width = np.maximum(new_maxs - new_mins, 1e-6)
+            moved = np.max(np.maximum(self.mins - new_mins, new_maxs - self.maxs) / width)
+            self.stable_batches = self.stable_batches + 1 if moved <= CALIBRATION_TOLERANCE else 0
+            self.mins, self.maxs = new_mins, new_maxs
+        self.samples += len(batch)
+
+    def converged(self):
+        return self.samples >= CALIBRATION_MIN_SAMPLES and self.stable_batches >= CALIBRATION_PATIENCE
+
+def calibration_batches(model, batches, available):
+    """Takes batches of calibration samples until the model's activation ranges settle, returns the ones taken.
+
+    None if adaptive calibration is off, can't stop before the samples run out or the model can't be probed, the
+    caller then calibrates on everything.
+    """
+    # Calibration never stops before CALIBRATION_MIN_SAMPLES, so probing fewer would only cost time.
+    if not CALIBRATION_TOLERANCE or available <= CALIBRATION_MIN_SAMPLES:
+        return None
+    try:
+        tracker = RangeTracker(model)
+    except Exception as e:
+        print('can not probe activation ranges, calibrating on every sample: '+str(e), flush=True)
+        return None
+    used = []
+    for batch in batches:
+        tracker.update(batch)
+        used.append(batch)
+        if tracker.converged():
+            break
+    print('activation ranges settled after {} samples'.format(tracker.samples) if tracker.converged() else
+          'activation ranges still moving after all {} samples'.format(tracker.samples), flush=True)
+    return used
+
+def split_holdout(files, holdout=QUANTIZATION_REPORT):
+    # Every n-th image of a class is kept out of calibration for the quantization report.
+    if not holdout or len(files) < 2:
+        return files, []
+    picks = set(np.linspace(0, len(files) - 1, max(1, int(len(files) * REPORT_HOLDOUT_FRACTION))).astype(int))
+    return ([name for index, name in enumerate(files) if index not in picks],
+            [name for index, name in enumerate(files) if index in picks])
+
+def list_report_images(job, holdout=QUANTIZATION_REPORT):
+    per_class = [split_holdout(files, holdout)[1] for files in list_dataset_images(job.dataset_zip, job.labels)]
+    limit = max(1, REPORT_MAX_IMAGES // max(1, len(per_class)))
+    return [(name, label) for label, files in enumerate(per_class) for name in files[:limit]]
+
+def evaluate_tflite(model_content, data):
+    interpreter = tf.lite.Interpreter(model_content=model_content)
+    interpreter.allocate_tensors()
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    # All tensors at once, an upper bound of the arena since the interpreter reuses activation buffers.
+    tensor_bytes = sum(int(np.prod(tensor['shape'])) * np.dtype(tensor['dtype']).itemsize
+                       for tensor in interpreter.get_tensor_details())
+    predictions = []
+    latencies = []
+    for index in range(len(data)):
+        sample = data[index:index + 1]
+        if input_details['dtype'] != np.float32:
+            scale, zero_point = input_details['quantization']
+            limits = np.iinfo(input_details['dtype'])
+            sample = np.clip(np.round(sample / scale + zero_point), limits.min, limits.max).astype(input_details['dtype'])
+        interpreter.set_tensor(input_details['index'], sample)
+        start = time.perf_counter()
+        interpreter.invoke()
+        latencies.append(time.perf_counter() - start)
+        predictions.append(int(np.argmax(interpreter.get_tensor(output_details['index']))))
+    stats = {'model_bytes': len(model_content), 'tensor_bytes': tensor_bytes,
+             'mean_invoke_seconds': float(np.mean(latencies)) if latencies else None}
+    return stats, np.array(predictions)
+
+def quantization_report(job, float_model, quantized_model):
+    float_stats, float_predictions = evaluate_tflite(float_model, job.report_data)
+    quantized_stats, quantized_predictions = evaluate_tflite(quantized_model, job.report_data)
+    classes = np.array(job.report_classes)
+    measured = len(classes) > 0
+    float_stats['accuracy'] = float(np.mean(float_predictions == classes)) if measured else None
+    quantized_stats['accuracy'] = float(np.mean(quantized_predictions == classes)) if measured else None
+    return {
+        'images': len(classes),
+        'float': float_stats,
+        'quantized': quantized_stats,
+        'size_ratio': quantized_stats['model_bytes'] / float_stats['model_bytes'],
+        'top1_agreement': float(np.mean(float_predictions == quantized_predictions)) if measured else None,
+        # Samples the quantization ranges were calibrated on, out of the ones available.
+        'calibration': job.calibration,
+    }
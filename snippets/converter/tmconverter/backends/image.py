@@ -0,0 +1,279 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Image models: keras, savedmodel, tflite, uint8 tflite and Edge TPU."""
+
+import io
+import json
+import os
+
+import numpy as np
+import PIL.Image
+import tensorflow as tf
+from fastapi import HTTPException
+
+from tmconverter.backends.backbone import (BACKBONE_KEYS, BACKBONE_SPLICE, backbone_key, cached_backbone, forget_backbone, splice_models,
+                                           split_backbone)
+from tmconverter.backends.common import (CALIBRATION_MAX_PER_CLASS, CALIBRATION_PROBE_BATCH, QUANTIZATION_REPORT,
+                                         calibration_batches, decode_executor, evaluate_tflite, list_report_images, load_tfjs_model, quantization_report,
+                                         split_holdout, warmup_formats)
+from tmconverter.backends.specs import IMAGE_FORMAT_FILES, IMAGE_FORMATS, IMAGE_QUANTIZED_FORMATS, ImageSpec
+from tmconverter.files import list_dataset_images, open_upload_zip, returnFiles, write_labels
+from tmconverter.jobs import ConversionJob
+
+IMAGE_SIZE = 224
+# Calibration sets larger than this are kept in a memory-mapped file in the job dir instead of RAM.
+CALIBRATION_MEMMAP_BYTES = int(os.environ.get('CALIBRATION_MEMMAP_BYTES', 512 * 1024 ** 2))
+WARMUP_FORMATS = set(warmup_formats(IMAGE_FORMATS, IMAGE_FORMATS))
+# A spliced model is only returned if it agrees this often with the keras model on the images held out of
+# calibration, and there are at least SPLICE_CHECK_MIN_IMAGES of them. Otherwise the whole model is converted.
+SPLICE_MIN_AGREEMENT = float(os.environ.get('SPLICE_MIN_AGREEMENT', 0.98))
+SPLICE_CHECK_MIN_IMAGES = 10
+
+class ImageJob(ConversionJob):
+    def __init__(self, formats, workspace=None):
+        stages = ['unzip', 'keras']
+        if formats != {'keras'}:
+            stages.append('savedmodel')
+        if 'tflite' in formats:
+            stages.append('tflite')
+        if formats & IMAGE_QUANTIZED_FORMATS:
+            stages.extend(['calibrate', 'tflite_quantized'])
+        if 'edgetpu' in formats:
+            stages.append('edgetpu')
+        if formats & IMAGE_QUANTIZED_FORMATS and QUANTIZATION_REPORT:
+            stages.append('report')
+        super().__init__('image', formats, stages, workspace)
+        self.calibration_data = None
+        self.calibration = None
+        self.report_data = None
+        self.report_classes = None
+        self.dataset_zip = None
+        self.splice = None
+        # Whether images are held out of calibration, for the report or to check a spliced model.
+        self.holdout = QUANTIZATION_REPORT
+
+def list_calibration_images(job):
+    per_class = []
+    for files in list_dataset_images(job.dataset_zip, job.labels):
+        files = split_holdout(files, job.holdout)[0]
+        if CALIBRATION_MAX_PER_CLASS and len(files) > CALIBRATION_MAX_PER_CLASS:
+            # Stratified sample: the same number of images from every class, spread over the whole class.
+            picks = np.linspace(0, len(files) - 1, CALIBRATION_MAX_PER_CLASS).astype(int)
+            files = [files[i] for i in picks]
+        per_class.append(files)
+    # Interleaved across classes, so calibration that stops early has still seen every class.
+    return [files[index] for index in range(max(map(len, per_class), default=0)) for files in per_class
+            if index < len(files)]
+
+def load_calibration_images(job, model):
+    """Decodes calibration images in batches until the activation ranges settle, if adaptive calibration is on."""
+    names = list_calibration_images(job)
+    data = image_array(job, len(names), 'calibration')
+    def batches():
+        for index in range(0, len(names), CALIBRATION_PROBE_BATCH):
+            yield decode_images(job, names[index:index + CALIBRATION_PROBE_BATCH],
+                                data[index:index + CALIBRATION_PROBE_BATCH])
+    used = calibration_batches(model, batches(), len(names))
+    if used is None:
+        job.calibration_data = decode_images(job, names, data)
+    else:
+        job.calibration_data = data[:sum(len(batch) for batch in used)]
+    job.calibration = {'samples': len(job.calibration_data), 'available': len(names)}
+    print('loaded {} of {} calibration images'.format(len(job.calibration_data), len(names)), flush=True)
+
+def load_report_images(job):
+    images = list_report_images(job, job.holdout)
+    job.report_classes = [label for _, label in images]
+    return load_images(job, [name for name, _ in images], 'report')
+
+def load_images(job, paths, name):
+    return decode_images(job, paths, image_array(job, len(paths), name))
+
+def image_array(job, count, name):
+    shape = (count, IMAGE_SIZE, IMAGE_SIZE, 3)
+    if np.prod(shape) * 4 > CALIBRATION_MEMMAP_BYTES:
+        return np.lib.format.open_memmap(job.data_dir + '/' + name + '.npy', mode='w+', dtype=np.float32, shape=shape)
+    return np.empty(shape, dtype=np.float32)
+
+def decode_images(job, paths, data):
+    # The workers only write raw pixels, the batch is then normalized in place in one vectorized pass.
+    def decode(index):
+        data[index] = decode_pixels(job.dataset_zip.read(paths[index]))
+    list(decode_executor.map(decode, range(len(paths))))
+    return normalize_images(data)
+
+def decode_pixels(content):
+    with PIL.Image.open(io.BytesIO(content)) as img:
+        img = img.convert('RGB')
+        if img.size != (IMAGE_SIZE, IMAGE_SIZE):
+            img = img.resize((IMAGE_SIZE, IMAGE_SIZE))
+        return np.asarray(img)
+
+def normalize_images(data):
+    # Scaled to [-1, 1] like the MobileNet feature extractor of Teachable Machine expects.
+    data /= 127.5
+    data -= 1.0
+    return data
+
+def decode_image(content):
+    return normalize_images(decode_pixels(content).astype(np.float32))
+
+def representative_dataset_gen(job):
+    # Images are decoded once per job, every pass of the converter reuses the same array.
+    for index in range(len(job.calibration_data)):
+        yield [job.calibration_data[index:index + 1]]
+
+def converterSavedModelTFLite(pathToSavedModel, job):
+    converter = tf.lite.TFLiteConverter.from_saved_model(pathToSavedModel)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.inference_input_type = tf.uint8
+    converter.inference_output_type = tf.uint8
+    converter.representative_dataset = lambda: representative_dataset_gen(job)
+    converter.allow_custom_ops = True
+    converter.change_concat_input_ranges = True
+    return converter.convert()
+
+def convertSavedModelTFLiteUnQuantized(pathToSavedModel):
+    converter = tf.lite.TFLiteConverter.from_saved_model(pathToSavedModel)
+    return converter.convert()
+
+def convertKerasTFLiteQuantized(keras_model, data):
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.inference_input_type = tf.uint8
+    converter.inference_output_type = tf.uint8
+    converter.representative_dataset = lambda: ([data[index:index + 1]] for index in range(len(data)))
+    return converter.convert()
+
+def convert_spliced(job, model, backbone, head, key):
+    """Quantizes only the head and splices it onto the bundled backbone, None if that isn't possible or good enough."""
+    backbone_model = cached_backbone(key)
+    if backbone_model is None:
+        return None
+    check_data = job.report_data
+    if check_data is None or len(check_data) < SPLICE_CHECK_MIN_IMAGES:
+        print('too few held out images to check a spliced model, converting the whole model', flush=True)
+        return None
+    try:
+        # The head is calibrated on what the float backbone makes of the calibration images.
+        features = backbone.predict(job.calibration_data, batch_size=32)
+        spliced_model = splice_models(backbone_model, convertKerasTFLiteQuantized(head, features))
+        _, predictions = evaluate_tflite(spliced_model, check_data)
+    except Exception as e:
+        print('splicing failed, converting the whole model from now on: '+str(e), flush=True)
+        forget_backbone(key)
+        return None
+    agreement = float(np.mean(predictions == np.argmax(model.predict(check_data), axis=1)))
+    # Reported in report.json, so whoever downloads the model can tell which conversion they got.
+    job.splice = {'backbone': key, 'agreement': agreement, 'images': len(check_data),
+                  'used': agreement >= SPLICE_MIN_AGREEMENT}
+    if not job.splice['used']:
+        print('spliced model agrees {:.2f} with keras, converting the whole model'.format(agreement), flush=True)
+        return None
+    print('spliced head onto bundled backbone '+key, flush=True)
+    return spliced_model
+
+def convert_keras_model(job, model, dataset):
+    # Each stage below is only run if one of the requested formats needs it or a later stage.
+    model_dir = job.model_dir
+    formats = job.formats
+    if 'keras' in formats:
+        model.save(model_dir + '/keras_model.h5')
+    if formats != {'keras'}:
+        # Generate savedmodel
+        job.set_stage('savedmodel')
+        print('converting model to saved model', flush=True)
+        model.save(model_dir + '/model.savedmodel')
+
+    if 'tflite' in formats:
+        # Generate tflite unquantized
+        job.set_stage('tflite')
+        tflite_unquant_model = convertSavedModelTFLiteUnQuantized(
+            model_dir + '/model.savedmodel')
+        open(model_dir + '/model_unquant.tflite', 'wb').write(tflite_unquant_model)
+
+    if formats & IMAGE_QUANTIZED_FORMATS:
+        # Generate tflite
+        job.set_stage('calibrate')
+        parts = split_backbone(model) if BACKBONE_SPLICE and BACKBONE_KEYS else None
+        key = backbone_key(parts[0], 'uint8') if parts else None
+        # Without the report, images are only held out if the model can be spliced onto a bundled backbone.
+        job.holdout = QUANTIZATION_REPORT or (key is not None and cached_backbone(key) is not None)
+        if job.calibration_data is None:
+            with open_upload_zip(dataset) as dataset_zip:
+                job.dataset_zip = dataset_zip
+                load_calibration_images(job, model)
+                if job.holdout:
+                    job.report_data = load_report_images(job)
+        job.set_stage('tflite_quantized')
+        print('convert model to tflite', flush=True)
+        tflite_quant_model = convert_spliced(job, model, parts[0], parts[1], key) if parts else None
+        if tflite_quant_model is None:
+            tflite_quant_model = converterSavedModelTFLite(
+                model_dir + '/model.savedmodel', job)
+        open(model_dir + '/model.tflite', 'wb').write(tflite_quant_model)
+
+    if 'edgetpu' in formats:
+        # Generate edgetpu model
+        job.set_stage('edgetpu')
+        print('compile model for edgetpu', flush=True)
+        status = os.system('edgetpu_compiler -s "' + model_dir +
+                           '/model.tflite" -o "' + model_dir + '"')
+        if status != 0:
+            raise HTTPException(status_code=500, detail="edgetpu_compiler failed with status {}".format(status))
+
+    ordered_formats = [format for format in IMAGE_FORMAT_FILES if format in formats]
+    filenames = [IMAGE_FORMAT_FILES[format] for format in ordered_formats]
+    if QUANTIZATION_REPORT and job.report_data is not None:
+        job.set_stage('report')
+        if 'tflite' not in formats:
+            tflite_unquant_model = convertSavedModelTFLiteUnQuantized(model_dir + '/model.savedmodel')
+        report = quantization_report(job, tflite_unquant_model, tflite_quant_model)
+        if os.path.isfile(model_dir + '/model_edgetpu.tflite'):
+            report['edgetpu'] = {'model_bytes': os.path.getsize(model_dir + '/model_edgetpu.tflite')}
+        report['backbone_splice'] = job.splice
+        with open(model_dir + '/report.json', 'w') as f:
+            json.dump(report, f, indent=2)
+        filenames.append('report.json')
+    return returnFiles(filenames, model_dir)
+
+class Backend(ImageSpec):
+    def create_job(self, formats, workspace=None):
+        return ImageJob(formats, workspace)
+
+    def convert(self, job, model, dataset):
+        return convert_keras_model(job, load_tfjs_model(job, model), dataset)
+
+    def warm_up(self):
+        """Runs a tiny built-in model through every warm-up format, so the first real request finds the converters initialized."""
+        if not WARMUP_FORMATS:
+            return
+        job = ImageJob(WARMUP_FORMATS)
+        job.warmup = True
+        try:
+            print('warming up '+', '.join(sorted(WARMUP_FORMATS)), flush=True)
+            job.labels = ['Class 1', 'Class 2']
+            write_labels(job.model_dir, job.labels)
+            model = tf.keras.Sequential([
+                tf.keras.layers.Conv2D(4, 3, strides=4, activation='relu', input_shape=(IMAGE_SIZE, IMAGE_SIZE, 3)),
+                tf.keras.layers.GlobalAveragePooling2D(),
+                tf.keras.layers.Dense(len(job.labels), activation='softmax'),
+            ])
+            job.calibration_data = np.random.uniform(-1.0, 1.0, (4, IMAGE_SIZE, IMAGE_SIZE, 3)).astype(np.float32)
+            convert_keras_model(job, model, None)
+            print('warm up done', flush=True)
+        except Exception as e:
+            print('warm up failed: '+str(e), flush=True)
+        finally:
+            job.release()
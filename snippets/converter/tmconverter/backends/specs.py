@@ -0,0 +1,87 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""The formats of every model type and how requests for them are checked, without importing TensorFlow.
+
+Requests are validated and looked up in the conversion cache with these alone, so a cache hit never waits for its
+backend to load. Each backend's `Backend` class extends its spec with the conversion itself.
+"""
+
+import shutil
+
+from fastapi import HTTPException
+
+# Output file of every image format, in the order the pipeline produces them.
+IMAGE_FORMAT_FILES = {
+    'keras': 'keras_model.h5',
+    'savedmodel': 'model.savedmodel',
+    'tflite': 'model_unquant.tflite',
+    'tflite_quantized': 'model.tflite',
+    'edgetpu': 'model_edgetpu.tflite',
+}
+IMAGE_QUANTIZED_FORMATS = {'tflite_quantized', 'edgetpu'}
+# edgetpu is only served where edgetpu_compiler is installed. The combined image leaves it out, its output hasn't
+# been verified with the TensorFlow version there.
+IMAGE_FORMATS = [format for format in IMAGE_FORMAT_FILES if format != 'edgetpu' or shutil.which('edgetpu_compiler')]
+TINY_FORMATS = ['keras', 'tflite', 'tinyml']
+AUDIO_FORMATS = ['tflite']
+
+class ImageSpec:
+    type = 'image'
+    formats = IMAGE_FORMATS
+
+    def validate(self, formats, dataset):
+        for format in formats:
+            if format not in IMAGE_FORMATS:
+                return {'invalid format': format}
+        if (formats & IMAGE_QUANTIZED_FORMATS and dataset == None):
+            return {'No representative dataset supplied'}
+        return None
+
+    def needs_dataset(self, formats):
+        return bool(formats & IMAGE_QUANTIZED_FORMATS)
+
+    def result_filename(self, formats):
+        return 'converted_model.zip'
+
+class TinyImageSpec:
+    type = 'tiny_image'
+    formats = TINY_FORMATS
+
+    def validate(self, formats, dataset):
+        if (len(formats) != 1 or not formats <= set(TINY_FORMATS) or ('tinyml' in formats and dataset == None)):
+            raise HTTPException(status_code=403, detail="bad request format")
+        return None
+
+    def needs_dataset(self, formats):
+        return 'tinyml' in formats
+
+    def result_filename(self, formats):
+        return 'arduino_sketch.zip' if 'tinyml' in formats else 'converted_model.zip'
+
+class AudioSpec:
+    type = 'audio'
+    formats = AUDIO_FORMATS
+
+    def validate(self, formats, dataset):
+        if formats != {'tflite'}:
+            return {'format not supported'}
+        return None
+
+    def needs_dataset(self, formats):
+        return False
+
+    def result_filename(self, formats):
+        return 'converted_model.zip'
+
+SPECS = {spec.type: spec for spec in (ImageSpec(), TinyImageSpec(), AudioSpec())}
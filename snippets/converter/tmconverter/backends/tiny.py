@@ -0,0 +1,272 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Tiny image models: keras, tflite and an INT8 Arduino sketch."""
+
+import io
+import json
+import os
+import re
+from collections import deque
+from contextlib import contextmanager
+from string import Template
+
+import numpy as np
+import PIL.Image
+import tensorflow as tf
+
+from tmconverter.backends.common import (CALIBRATION_MAX_PER_CLASS, CALIBRATION_PROBE_BATCH, QUANTIZATION_REPORT,
+                                         calibration_batches, decode_executor,
+                                         list_report_images, load_tfjs_model, quantization_report, split_holdout,
+                                         warmup_formats)
+from tmconverter.backends.specs import TINY_FORMATS, TinyImageSpec
+from tmconverter.files import list_dataset_images, open_upload_zip, returnFiles, returnFolder, write_labels
+from tmconverter.jobs import ConversionJob
+
+IMAGE_SIZE = 96
+# Folder with the Arduino sketch the tinyml model is written into, relative to the working directory.
+SKETCH_TEMPLATE_DIR = os.environ.get('SKETCH_TEMPLATE_DIR', 'tm_template_script')
+# Sketch files that get the model and labels filled in, the others are hardlinked into the job as they are.
+SKETCH_TEMPLATED_FILES = ('person_detect_model_data.cpp', 'model_settings.h', 'model_settings.cpp')
+WARMUP_FORMATS = warmup_formats(TINY_FORMATS, ['tflite', 'tinyml'])
+# '0xNN, ' for every byte value, one row of characters per value.
+C_ARRAY_LITERALS = np.array([list('0x{:02x}, '.format(value).encode()) for value in range(256)], dtype=np.uint8)
+C_ARRAY_BYTES_PER_LINE = 12
+
+class TinyJob(ConversionJob):
+    def __init__(self, formats, workspace=None):
+        format = next(iter(formats))
+        stages = ['unzip', 'keras']
+        if format != 'keras':
+            stages.append('tflite')
+        if format == 'tinyml':
+            stages.append('sketch')
+            if QUANTIZATION_REPORT:
+                stages.append('report')
+        super().__init__('tiny_image', formats, stages, workspace)
+        self.dataset_zip = None
+        self.calibration_samples = None
+        self.calibration = None
+        self.report_data = None
+        self.report_classes = None
+
+@contextmanager
+def isolated_graph():
+    # TF 1.x keeps keras models in the default graph and session, give every job its own (both are thread local).
+    if tf.executing_eagerly():
+        yield
+        return
+    graph = tf.Graph()
+    session = tf.compat.v1.Session(graph=graph)
+    try:
+        with graph.as_default(), session.as_default():
+            yield
+    finally:
+        session.close()
+
+def load_calibration_image(dataset_zip, name):
+    with PIL.Image.open(io.BytesIO(dataset_zip.read(name))) as img:
+        img = img.resize((IMAGE_SIZE, IMAGE_SIZE))
+        img = img.convert('L')
+        array = np.asarray(img, dtype=np.float32)
+    array = (array / 127.5) - 1.0
+    return array.reshape(1, IMAGE_SIZE, IMAGE_SIZE, 1)
+
+def load_report_images(job):
+    images = list_report_images(job)
+    job.report_classes = [label for _, label in images]
+    samples = list(decode_executor.map(lambda image: load_calibration_image(job.dataset_zip, image[0]), images))
+    return np.concatenate(samples) if samples else np.empty((0, IMAGE_SIZE, IMAGE_SIZE, 1), dtype=np.float32)
+
+def list_calibration_images(job):
+    per_class = []
+    for files in list_dataset_images(job.dataset_zip, job.labels):
+        files = split_holdout(files)[0]
+        if CALIBRATION_MAX_PER_CLASS and len(files) > CALIBRATION_MAX_PER_CLASS:
+            # Stratified sample: the same number of images from every class, spread over the whole class.
+            picks = np.linspace(0, len(files) - 1, CALIBRATION_MAX_PER_CLASS).astype(int)
+            files = [files[i] for i in picks]
+        per_class.append(files)
+    # Interleaved across classes, so calibration that stops early has still seen every class.
+    return [files[index] for index in range(max(map(len, per_class), default=0)) for files in per_class
+            if index < len(files)]
+
+def load_calibration_samples(job, model):
+    """Decodes calibration images until the activation ranges settle, if adaptive calibration is on."""
+    names = list_calibration_images(job)
+    def batches():
+        for index in range(0, len(names), CALIBRATION_PROBE_BATCH):
+            yield np.concatenate(list(decode_executor.map(lambda name: load_calibration_image(job.dataset_zip, name),
+                                                          names[index:index + CALIBRATION_PROBE_BATCH])))
+    used = calibration_batches(model, batches(), len(names))
+    if used is not None:
+        job.calibration_samples = [batch[index:index + 1] for batch in used for index in range(len(batch))]
+    samples = len(job.calibration_samples) if used is not None else len(names)
+    job.calibration = {'samples': samples, 'available': len(names)}
+
+def representative_dataset_gen(job):
+    if job.calibration_samples is not None:
+        for sample in job.calibration_samples:
+            yield [sample]
+        return
+    # Decode a bounded window of images ahead in the worker pool while the converter consumes the current one.
+    pending = deque()
+    for name in list_calibration_images(job):
+        pending.append(decode_executor.submit(load_calibration_image, job.dataset_zip, name))
+        if len(pending) >= os.cpu_count() * 2:
+            yield [pending.popleft().result()]
+    while pending:
+        yield [pending.popleft().result()]
+
+def tflite_converter_from_keras(keras_model):
+    # TF 1.x only has the v1 converter, which converts a live keras model through its session.
+    if hasattr(tf.lite.TFLiteConverter, 'from_keras_model'):
+        return tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    return tf.lite.TFLiteConverter.from_session(tf.keras.backend.get_session(), keras_model.inputs, keras_model.outputs)
+
+def load_sketch_templates(folder):
+    """Parses the files that are filled in per model into Templates once, the others are kept by path."""
+    templates = {}
+    for dirname, subdirs, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(dirname, name)
+            relpath = os.path.relpath(path, folder)
+            if relpath in SKETCH_TEMPLATED_FILES:
+                with open(path) as f:
+                    templates[relpath] = Template(f.read())
+            else:
+                templates[relpath] = path
+    return templates
+
+def sketch_arena_bytes(path):
+    with open(path) as f:
+        match = re.search(r'kTensorArenaSize\s*=\s*(\d+)\s*\*\s*1024', f.read())
+    return int(match.group(1)) * 1024 if match else None
+
+SKETCH_TEMPLATES = load_sketch_templates(SKETCH_TEMPLATE_DIR)
+# Size of the fixed arena the sketch allocates the model's activations in.
+SKETCH_ARENA_BYTES = sketch_arena_bytes(SKETCH_TEMPLATES['tm_template_script.ino'])
+
+def format_labels(labels):
+    retStr = ''
+    for i in range(len(labels)):
+        label = labels[i]
+        retStr += '"{}",'.format(label)
+
+    return retStr
+
+def c_array_body(data):
+    """The bytes as the hex literals of a C array, 12 to a line like `xxd -i` writes them."""
+    chars = C_ARRAY_LITERALS[np.frombuffer(data, dtype=np.uint8)]
+    full = len(data) // C_ARRAY_BYTES_PER_LINE * C_ARRAY_BYTES_PER_LINE
+    line_chars = C_ARRAY_BYTES_PER_LINE * C_ARRAY_LITERALS.shape[1]
+    # Every full line ends in ',\n' followed by the two spaces the next line is indented with.
+    lines = np.full((full // C_ARRAY_BYTES_PER_LINE, line_chars + 2), ord(' '), dtype=np.uint8)
+    lines[:, :line_chars] = chars[:full].reshape(-1, line_chars)
+    lines[:, line_chars - 1] = ord('\n')
+    return (lines.tobytes() + chars[full:].tobytes()).rstrip(b', \n').decode('ascii')
+
+def write_arduino_sketch(workspace, sketch_dir, model_content, labels):
+    values = {
+        'model_buf': c_array_body(model_content),
+        'model_buf_len': len(model_content),
+        'numClasses': len(labels),
+        'labels': format_labels(labels),
+    }
+    print('writing {} model flatbuffer bytes'.format(len(model_content)))
+    for relpath, template in SKETCH_TEMPLATES.items():
+        path = os.path.join(sketch_dir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(template, Template):
+            with open(path, 'w') as f:
+                f.write(template.safe_substitute(values))
+        else:
+            workspace.link_input(template, path)
+
+def convert_keras_model(job, model, dataset):
+    model_dir = job.model_dir
+    format = job.format
+    if format == 'keras':
+        model.save(model_dir + '/keras_model.h5')
+        return returnFiles(['keras_model.h5'], model_dir)
+
+    job.set_stage('tflite')
+    converter = tflite_converter_from_keras(model)
+    converter.optimizations=[tf.lite.Optimize.DEFAULT]
+
+    if format == 'tflite':
+        tf_quant_model = converter.convert()
+        open(model_dir + '/vww_96_grayscale_quantized.tflite', 'wb').write(tf_quant_model)
+        return returnFiles(['vww_96_grayscale_quantized.tflite'], model_dir)
+    if format == 'tinyml':
+        # tf.int8 is what tf.lite.constants.INT8 pointed to in TF 1.x, and the only spelling left in TF 2.x.
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+        converter.representative_dataset = lambda: representative_dataset_gen(job)
+        if job.calibration_samples is None:
+            with open_upload_zip(dataset) as dataset_zip:
+                job.dataset_zip = dataset_zip
+                load_calibration_samples(job, model)
+                tf_quant_model = converter.convert()
+                if QUANTIZATION_REPORT:
+                    job.report_data = load_report_images(job)
+        else:
+            tf_quant_model = converter.convert()
+        job.set_stage('sketch')
+        # The sketch is rendered straight from the flatbuffer in memory, the model file itself isn't returned.
+        write_arduino_sketch(job.workspace, model_dir + '/tm_template_script', tf_quant_model, job.labels)
+
+        entries = returnFolder('/tm_template_script', model_dir)
+        if job.report_data is not None:
+            job.set_stage('report')
+            float_model = tflite_converter_from_keras(model).convert()
+            report = quantization_report(job, float_model, tf_quant_model)
+            report['sketch_arena_bytes'] = SKETCH_ARENA_BYTES
+            with open(model_dir + '/report.json', 'w') as f:
+                json.dump(report, f, indent=2)
+            entries.append(('report.json', model_dir + '/report.json'))
+        return entries
+
+class Backend(TinyImageSpec):
+    def create_job(self, formats, workspace=None):
+        return TinyJob(formats, workspace)
+
+    def convert(self, job, model, dataset):
+        with isolated_graph():
+            return convert_keras_model(job, load_tfjs_model(job, model), dataset)
+
+    def warm_up(self):
+        """Runs a tiny built-in model through every warm-up format, so the first real request finds the converters initialized."""
+        if not WARMUP_FORMATS:
+            return
+        print('warming up '+', '.join(WARMUP_FORMATS), flush=True)
+        for format in WARMUP_FORMATS:
+            job = TinyJob({format})
+            job.warmup = True
+            try:
+                with isolated_graph():
+                    job.labels = ['Class 1', 'Class 2']
+                    write_labels(job.model_dir, job.labels)
+                    model = tf.keras.Sequential([
+                        tf.keras.layers.Conv2D(4, 3, strides=4, activation='relu', input_shape=(IMAGE_SIZE, IMAGE_SIZE, 1)),
+                        tf.keras.layers.GlobalAveragePooling2D(),
+                        tf.keras.layers.Dense(len(job.labels), activation='softmax'),
+                    ])
+                    job.calibration_samples = [np.random.uniform(-1.0, 1.0, (1, IMAGE_SIZE, IMAGE_SIZE, 1)).astype(np.float32)
+                                               for _ in range(4)]
+                    convert_keras_model(job, model, None)
+            except Exception as e:
+                print('warm up of '+format+' failed: '+str(e), flush=True)
+            finally:
+                job.release()
+        print('warm up done', flush=True)
@@ -0,0 +1,120 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Converting many uploaded models in one request."""
+
+import json
+import os
+import shutil
+from concurrent.futures import as_completed
+
+from fastapi import HTTPException
+from starlette.responses import StreamingResponse
+
+from tmconverter.files import CHUNK_SIZE
+from tmconverter.jobs import executor, run_job
+from tmconverter.results import iter_zip, iterate_in_threadpool
+from tmconverter.workspace import open_workspace
+
+BATCH_MAX_MODELS = int(os.environ.get('BATCH_MAX_MODELS', 100))
+
+class BatchItem:
+    """One model of a batch, with the job converting it or the reason it was rejected."""
+    def __init__(self, name):
+        self.name = name
+        self.job = None
+        self.future = None
+        self.error = None
+
+    def status(self):
+        if self.error:
+            return {'name': self.name, 'stage': 'rejected', 'error': self.error}
+        if self.job is None:
+            return {'name': self.name, 'stage': 'queued', 'error': None}
+        status = self.job.status()
+        status.update(name=self.name, timings=self.job.timings)
+        return status
+
+def extract_bundles(batch_zip, data_dir):
+    """Writes every `<name>/model.zip` and `<name>/dataset.zip` of the batch to disk, returns their paths by name."""
+    bundles = {}
+    for info in batch_zip.infolist():
+        folder, _, filename = info.filename.rpartition('/')
+        if filename in ('model.zip', 'dataset.zip') and folder and not folder.startswith('__MACOSX'):
+            bundles.setdefault(folder, {})[filename] = info
+    bundles = {name: files for name, files in bundles.items() if 'model.zip' in files}
+    if len(bundles) > BATCH_MAX_MODELS:
+        raise HTTPException(status_code=413, detail="too many models")
+    paths = {}
+    for index, (name, files) in enumerate(sorted(bundles.items())):
+        paths[name] = {}
+        for filename, info in files.items():
+            # Numbered, the bundle names come from the upload and may not be safe paths.
+            path = os.path.join(data_dir, '{}-{}'.format(index, filename))
+            with batch_zip.open(info) as src, open(path, 'wb') as dest:
+                shutil.copyfileobj(src, dest, CHUNK_SIZE)
+            paths[name][filename] = path
+    return paths
+
+def run_item(backend, formats, item, paths):
+    # The workspace is only reserved once a worker picks the model up, so a long batch doesn't hold room for
+    # models that are still queued.
+    try:
+        workspace = open_workspace(sum(os.path.getsize(path) for path in paths.values()))
+    except HTTPException as e:
+        item.error = str(e.detail)
+        return
+    item.job = backend.create_job(formats, workspace)
+    run_job(backend, item.job, paths['model.zip'], paths.get('dataset.zip'))
+
+def start_batch(backend, formats, bundles):
+    items = []
+    for name, paths in sorted(bundles.items()):
+        item = BatchItem(name)
+        try:
+            error = backend.validate(formats, paths.get('dataset.zip'))
+        except HTTPException as e:
+            error = e.detail
+        if error:
+            item.error = str(error)
+        else:
+            item.future = executor.submit(run_item, backend, formats, item, paths)
+        items.append(item)
+    return items
+
+def iter_batch(items, data_dir):
+    # Results are added as soon as their model is converted, a failed model only shows up in status.json.
+    futures = {item.future: item for item in items if item.future}
+    for future in as_completed(futures):
+        item = futures[future]
+        if item.job is None or item.job.stage != 'done':
+            continue
+        for arcname, path in item.job.result_entries:
+            yield item.name + '/' + arcname, path
+    with open(data_dir + '/status.json', 'w') as f:
+        json.dump([item.status() for item in items], f, indent=2)
+    yield 'status.json', data_dir + '/status.json'
+
+def batch_response(items, data_dir):
+    headers = {'Content-Disposition': 'attachment; filename="converted_models.zip"'}
+    return StreamingResponse(iterate_in_threadpool(iter_zip(iter_batch(items, data_dir), stage=None)),
+                             media_type='application/octet-stream', headers=headers)
+
+def cleanup_batch(items, workspace):
+    for item in items:
+        if item.future:
+            # Only reached early if the client went away, the job's files are in use until it is done.
+            item.future.result()
+            if item.job:
+                item.job.release()
+    workspace.release()
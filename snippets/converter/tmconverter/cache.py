@@ -0,0 +1,75 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+from tmconverter.files import CHUNK_SIZE
+
+CACHE_DIR = os.environ.get('CONVERTER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'tm_converter_cache'))
+CACHE_MAX_BYTES = int(os.environ.get('CONVERTER_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+def hash_uploads(type, format, model, dataset):
+    # Key the cache on the uploaded bytes and the requested output, so re-exports of the same project hit.
+    digest = hashlib.sha256('{}/{}'.format(type, format).encode())
+    for upload in (model, dataset):
+        digest.update(b'\0')
+        if upload is None:
+            continue
+        upload.file.seek(0)
+        for chunk in iter(lambda: upload.file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+        upload.file.seek(0)
+    return digest.hexdigest()
+
+def cache_lookup(cache_key):
+    cached_path = os.path.join(CACHE_DIR, cache_key + '.zip')
+    if not os.path.isfile(cached_path):
+        return None
+    # Bump the mtime so eviction treats the entry as recently used.
+    os.utime(cached_path, None)
+    return cached_path
+
+def link_cached(cached_path, dest):
+    """Gives dest its own link to the cached zip, so evicting the entry doesn't delete it. Returns dest."""
+    try:
+        os.link(cached_path, dest)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        # The cache is on another filesystem than the workspace, a RAM one for instance.
+        shutil.copyfile(cached_path, dest)
+    return dest
+
+def evict_cache():
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if not name.endswith('.zip'):
+            continue
+        try:
+            stat = os.stat(os.path.join(CACHE_DIR, name))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        print("### EVICTING CACHE ENTRY "+name, flush=True)
+        try:
+            os.remove(os.path.join(CACHE_DIR, name))
+        except FileNotFoundError:
+            pass
+        total -= size
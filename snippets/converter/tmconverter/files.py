@@ -0,0 +1,106 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+import json
+import os
+import shutil
+import zipfile
+
+from fastapi import HTTPException
+
+CHUNK_SIZE = 1024 * 1024
+# Limits on uploaded zips, so a zip bomb can't exhaust the worker's memory or disk.
+ZIP_MAX_ENTRIES = int(os.environ.get('ZIP_MAX_ENTRIES', 20000))
+ZIP_MAX_BYTES = int(os.environ.get('ZIP_MAX_BYTES', 2 * 1024 ** 3))
+
+def open_upload_zip(file):
+    upload_zip = zipfile.ZipFile(file, 'r')
+    members = upload_zip.infolist()
+    if len(members) > ZIP_MAX_ENTRIES or sum(member.file_size for member in members) > ZIP_MAX_BYTES:
+        upload_zip.close()
+        raise HTTPException(status_code=413, detail="zip file too large")
+    return upload_zip
+
+def extract_model(file, model_dir):
+    # Only the files the converter reads are written to disk, anything else in the zip is skipped.
+    with open_upload_zip(file) as model_zip:
+        names = set(model_zip.namelist())
+        model_json = json.loads(model_zip.read('model.json').decode('utf-8'))
+        members = ['model.json', 'metadata.json']
+        for group in model_json.get('weightsManifest', []):
+            members.extend(group['paths'])
+        for name in members:
+            if name in names:
+                model_zip.extract(name, model_dir)
+
+def list_dataset_images(dataset_zip, labels):
+    # The dataset zip has one folder per label, images are read straight from the zip without extracting them.
+    images = {label: [] for label in labels}
+    for name in dataset_zip.namelist():
+        folder, _, filename = name.partition('/')
+        if folder in images and filename and '/' not in filename and not filename.startswith('.'):
+            images[folder].append(name)
+    return [sorted(images[label]) for label in labels]
+
+def write_labels(model_dir, labels):
+    with open(model_dir + '/labels.txt', 'w') as f:
+        for idx, label in enumerate(labels):
+            f.write("{} {}\n".format(idx, label))
+
+def upload_size(upload):
+    if upload is None:
+        return 0
+    upload.file.seek(0, os.SEEK_END)
+    size = upload.file.tell()
+    upload.file.seek(0)
+    return size
+
+def save_upload(upload, path):
+    upload.file.seek(0)
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(upload.file, f, CHUNK_SIZE)
+    return path
+
+def returnFiles(filenames, model_dir):
+    entries = []
+    for filename in filenames:
+        # If the file is a savedmodel directory, recursively add the files in it.
+        if os.path.isdir(model_dir + '/' + filename):
+            for dirname, subdirs, files in os.walk(model_dir + '/' + filename):
+                # We use  relpath to remove the /tmp/xxxxx/ from the archive paths.
+                entries.append((os.path.relpath(dirname, model_dir) + '/', None))
+                for name in files:
+                    entries.append((os.path.relpath(os.path.join(dirname, name), model_dir), os.path.join(dirname, name)))
+        else:
+            entries.append((filename, model_dir + '/' + filename))
+
+    entries.append(('labels.txt', model_dir + '/labels.txt'))
+    return entries
+
+def check_entries(entries):
+    # Entries are only opened once the response has started, a file missing then would cut the zip short after a 200.
+    for arcname, path in entries:
+        if path is not None and not os.path.isfile(path):
+            raise HTTPException(status_code=500, detail="conversion produced no " + arcname)
+    return entries
+
+def returnFolder(folderName, model_dir):
+    # Returns the content of the folder at the root of the zip.
+    entries = []
+    folder = model_dir + folderName
+    for dirname, subdirs, files in os.walk(folder):
+        for name in sorted(subdirs):
+            entries.append((os.path.relpath(os.path.join(dirname, name), folder) + '/', None))
+        for name in sorted(files):
+            entries.append((os.path.relpath(os.path.join(dirname, name), folder), os.path.join(dirname, name)))
+    return entries
@@ -0,0 +1,128 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from tmconverter.files import check_entries
+from tmconverter.metrics import measure_stage, resource_snapshot
+from tmconverter.workspace import open_workspace
+
+CONVERSION_WORKERS = int(os.environ.get('CONVERSION_WORKERS', 2))
+# Conversions run in this bounded pool so the event loop stays free and at most CONVERSION_WORKERS run at once.
+executor = ThreadPoolExecutor(max_workers=CONVERSION_WORKERS)
+jobs_lock = threading.Lock()
+activeJobs = 0
+# Jobs submitted through /jobs, by id. Finished jobs are dropped once downloaded or after JOB_TTL_SECONDS.
+jobs = {}
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', 3600))
+
+class ConversionJob:
+    """State of a single conversion request, so concurrent requests never share labels or paths."""
+    def __init__(self, type, formats, stages, workspace=None):
+        self.type = type
+        self.formats = formats
+        self.labels = []
+        # Jobs created without one, like the warm-ups, get a workspace for a small model.
+        self.workspace = workspace or open_workspace()
+        self.model_dir = self.workspace.model_dir
+        self.data_dir = self.workspace.data_dir
+        print("### Created "+self.workspace.path)
+        self.id = uuid.uuid4().hex
+        self.stage = 'queued'
+        self.stages = stages
+        self.result_path = None
+        self.result_entries = None
+        self.result_filename = None
+        self.cache_key = None
+        self.error = None
+        self.finished_at = None
+        self.timings = []
+        self.stage_start = None
+        # Warm-up conversions are left out of /metrics.
+        self.warmup = False
+
+    @property
+    def format(self):
+        # For backends that convert to a single format per request.
+        return next(iter(self.formats))
+
+    def set_stage(self, stage):
+        self.end_stage()
+        if stage in self.stages:
+            # What the previous stages wrote counts against the job's quota.
+            self.workspace.check_quota()
+        print('### JOB '+self.id+' '+stage, flush=True)
+        self.stage = stage
+        if stage in self.stages:
+            self.stage_start = resource_snapshot()
+
+    def end_stage(self):
+        if self.stage_start:
+            self.timings.append(measure_stage(self.stage, self.stage_start, record=not self.warmup))
+            self.stage_start = None
+
+    def status(self):
+        if self.stage == 'done':
+            progress = 1.0
+        elif self.stage in self.stages:
+            progress = self.stages.index(self.stage) / len(self.stages)
+        else:
+            progress = 0.0
+        return {'id': self.id, 'stage': self.stage, 'progress': progress, 'error': self.error}
+
+    def release(self):
+        self.workspace.release()
+
+def job_started():
+    global activeJobs
+    with jobs_lock:
+        activeJobs += 1
+
+def job_finished():
+    global activeJobs
+    with jobs_lock:
+        activeJobs -= 1
+
+def run_conversion(backend, job, model, dataset):
+    job_started()
+    try:
+        return check_entries(backend.convert(job, model, dataset))
+    finally:
+        job.end_stage()
+        job_finished()
+
+def run_job(backend, job, model_path, dataset_path):
+    try:
+        dataset = open(dataset_path, 'rb') if dataset_path else None
+        try:
+            with open(model_path, 'rb') as model:
+                job.result_entries = run_conversion(backend, job, model, dataset)
+        finally:
+            if dataset:
+                dataset.close()
+        job.set_stage('done')
+    except Exception as e:
+        # HTTPExceptions raised by the conversion, like a zip over the limits, carry their message in detail.
+        job.error = getattr(e, 'detail', None) or str(e)
+        job.set_stage('failed')
+    job.finished_at = time.time()
+
+def expire_jobs():
+    for job in list(jobs.values()):
+        if job.finished_at and time.time() - job.finished_at > JOB_TTL_SECONDS:
+            jobs.pop(job.id, None)
+            job.release()
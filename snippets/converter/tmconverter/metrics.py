@@ -0,0 +1,149 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+import os
+import resource
+import threading
+import time
+import weakref
+
+# Per stage totals behind /metrics, STAGE_SECONDS_BUCKETS are the upper bounds of the stage time histogram.
+STAGE_SECONDS_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+stage_metrics = {}
+metrics_lock = threading.Lock()
+# Seconds each heavy module took to import, by module name.
+import_seconds = {}
+# Job workspaces opened so far, by storage.
+workspaces_opened = {'ram': 0, 'disk': 0}
+# The RSS of the process is sampled this often while a stage is measured.
+RSS_SAMPLE_SECONDS = 0.05
+PAGE_BYTES = os.sysconf('SC_PAGE_SIZE')
+running_peaks = weakref.WeakSet()
+rss_sampler = None
+
+class PeakRss:
+    """Highest RSS sampled since it was created, for as long as a snapshot refers to it."""
+    def __init__(self, rss):
+        self.value = rss
+
+def current_rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_BYTES
+    except OSError:
+        return None
+
+def sample_rss():
+    while True:
+        time.sleep(RSS_SAMPLE_SECONDS)
+        with metrics_lock:
+            peaks = list(running_peaks)
+        rss = current_rss_bytes() if peaks else None
+        for peak in peaks if rss is not None else []:
+            peak.value = max(peak.value, rss)
+
+def track_peak_rss():
+    global rss_sampler
+    rss = current_rss_bytes()
+    if rss is None:
+        return None
+    peak = PeakRss(rss)
+    with metrics_lock:
+        running_peaks.add(peak)
+        if rss_sampler is None:
+            rss_sampler = threading.Thread(target=sample_rss, daemon=True)
+            rss_sampler.start()
+    return peak
+
+def resource_snapshot():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    read_bytes = written_bytes = 0
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name == 'read_bytes':
+                    read_bytes = int(value)
+                elif name == 'write_bytes':
+                    written_bytes = int(value)
+    except OSError:
+        pass
+    return {'wall': time.time(), 'cpu': usage.ru_utime + usage.ru_stime, 'read_bytes': read_bytes,
+            'written_bytes': written_bytes, 'rss': track_peak_rss()}
+
+def measure_stage(stage, start, record=True):
+    """The timings of a stage begun at the start snapshot, added to /metrics unless record is False."""
+    # CPU time, I/O and RSS are process wide, so they include whatever other jobs ran at the same time.
+    end = resource_snapshot()
+    peak = start['rss']
+    timing = {
+        'stage': stage,
+        'seconds': end['wall'] - start['wall'],
+        'cpu_seconds': end['cpu'] - start['cpu'],
+        'read_bytes': end['read_bytes'] - start['read_bytes'],
+        'written_bytes': end['written_bytes'] - start['written_bytes'],
+        'peak_rss_bytes': max(peak.value, end['rss'].value) if peak and end['rss'] else None,
+    }
+    if not record:
+        return timing
+    with metrics_lock:
+        metrics = stage_metrics.setdefault(stage, {
+            'runs': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'read_bytes': 0, 'written_bytes': 0,
+            'buckets': [0] * len(STAGE_SECONDS_BUCKETS)})
+        metrics['runs'] += 1
+        for key in ('seconds', 'cpu_seconds', 'read_bytes', 'written_bytes'):
+            metrics[key] += timing[key]
+        for index, bound in enumerate(STAGE_SECONDS_BUCKETS):
+            if timing['seconds'] <= bound:
+                metrics['buckets'][index] += 1
+    return timing
+
+def record_import(module, seconds):
+    print('### IMPORTED {} in {:.2f}s'.format(module, seconds), flush=True)
+    with metrics_lock:
+        import_seconds[module] = seconds
+
+def record_workspace(storage):
+    with metrics_lock:
+        workspaces_opened[storage] += 1
+
+def format_metrics(active_jobs, workspace_bytes):
+    lines = []
+    def add(name, kind, help, samples):
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in samples:
+            lines.append('{}{} {}'.format(name, labels, value))
+    with metrics_lock:
+        stages = sorted(stage_metrics.items())
+        add('converter_stage_seconds', 'histogram', 'Wall time of each conversion stage.',
+            [('_bucket{{stage="{}",le="{}"}}'.format(stage, bound), count)
+             for stage, metrics in stages for bound, count in zip(STAGE_SECONDS_BUCKETS, metrics['buckets'])] +
+            [('_bucket{{stage="{}",le="+Inf"}}'.format(stage), metrics['runs']) for stage, metrics in stages] +
+            [('_sum{{stage="{}"}}'.format(stage), metrics['seconds']) for stage, metrics in stages] +
+            [('_count{{stage="{}"}}'.format(stage), metrics['runs']) for stage, metrics in stages])
+        for key, help in (('cpu_seconds', 'Process CPU time spent in each conversion stage.'),
+                          ('read_bytes', 'Bytes read from storage during each conversion stage.'),
+                          ('written_bytes', 'Bytes written to storage during each conversion stage.')):
+            add('converter_stage_{}_total'.format(key), 'counter', help,
+                [('{{stage="{}"}}'.format(stage), metrics[key]) for stage, metrics in stages])
+        add('converter_workspaces_total', 'counter', 'Job workspaces opened, in RAM and on disk.',
+            [('{{storage="{}"}}'.format(storage), count) for storage, count in sorted(workspaces_opened.items())])
+        add('converter_import_seconds', 'gauge', 'Time it took to import each heavy module at startup.',
+            [('{{module="{}"}}'.format(module), seconds) for module, seconds in sorted(import_seconds.items())])
+    add('converter_peak_rss_bytes', 'gauge', 'Peak resident set size of the converter process.',
+        [('', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)])
+    add('converter_active_jobs', 'gauge', 'Conversions currently running.', [('', active_jobs)])
+    add('converter_workspace_bytes', 'gauge', 'Bytes reserved by the open job workspaces, in RAM and on disk.',
+        [('{{storage="{}"}}'.format(storage), value) for storage, value in sorted(workspace_bytes.items())])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,130 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+import json
+import os
+import tempfile
+import time
+import zipfile
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse
+
+from tmconverter.cache import CACHE_DIR, evict_cache
+from tmconverter.files import CHUNK_SIZE, check_entries
+from tmconverter.metrics import measure_stage, resource_snapshot
+
+# Store already dense artifacts in the returned zip instead of deflating them, set ZIP_STORE_DENSE=false to deflate everything.
+ZIP_STORE_DENSE = os.environ.get('ZIP_STORE_DENSE', 'true').lower() != 'false'
+DENSE_EXTENSIONS = ('.tflite', '.h5')
+
+class ZipStream:
+    """Write-only buffer the zip is written into, drained into the response after every chunk."""
+    def __init__(self):
+        self.buffer = bytearray()
+    def write(self, data):
+        self.buffer.extend(data)
+        return len(data)
+    def flush(self):
+        pass
+    def drain(self):
+        data = bytes(self.buffer)
+        del self.buffer[:]
+        return data
+
+def iter_zip(entries, cache_key=None, stage='zip'):
+    # entries are (archive name, file path) pairs, a None path adds a directory entry. stage=None skips measuring,
+    # for entries that are still being produced while the zip streams.
+    start = resource_snapshot()
+    stream = ZipStream()
+    cache_file = None
+    if cache_key:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        cache_file = tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix='.tmp', delete=False)
+    try:
+        with zipfile.ZipFile(stream, 'w') as zip:
+            for arcname, path in entries:
+                info = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+                if path is None:
+                    info.external_attr = (0o40755 << 16) | 0x10
+                    zip.writestr(info, b'')
+                    continue
+                info.external_attr = 0o644 << 16
+                # .tflite and .h5 files barely shrink, deflating them only burns CPU.
+                if ZIP_STORE_DENSE and arcname.endswith(DENSE_EXTENSIONS):
+                    info.compress_type = zipfile.ZIP_STORED
+                else:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                with open(path, 'rb') as src, zip.open(info, 'w') as dest:
+                    for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                        dest.write(chunk)
+                        data = stream.drain()
+                        if cache_file:
+                            cache_file.write(data)
+                        if data:
+                            yield data
+        data = stream.drain()
+        if cache_file:
+            cache_file.write(data)
+            cache_file.close()
+            os.replace(cache_file.name, os.path.join(CACHE_DIR, cache_key + '.zip'))
+            cache_file = None
+            evict_cache()
+        if data:
+            yield data
+        if stage:
+            measure_stage(stage, start)
+    finally:
+        # Only reached with an open cache file if the client went away before the zip was complete.
+        if cache_file:
+            cache_file.close()
+            os.remove(cache_file.name)
+
+async def iterate_in_threadpool(iterator):
+    while True:
+        chunk = await run_in_threadpool(next, iterator, None)
+        if chunk is None:
+            break
+        yield chunk
+
+def zip_response(entries, filename, cache_key=None, timings=None):
+    headers = {'Content-Disposition': 'attachment; filename="{}"'.format(filename)}
+    if timings is not None:
+        headers['X-Conversion-Timing'] = json.dumps(timings)
+    check_entries(entries)
+    return StreamingResponse(iterate_in_threadpool(iter_zip(entries, cache_key)), media_type='application/octet-stream',
+                             headers=headers)
+
+def iter_file(f):
+    with f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            yield chunk
+
+def cached_response(cached_path, filename):
+    """Streams a cached zip, None if it was evicted since the lookup.
+
+    The file is opened right away, evicting the entry while the response streams doesn't take it away.
+    """
+    try:
+        f = open(cached_path, 'rb')
+    except FileNotFoundError:
+        return None
+    headers = {'Content-Disposition': 'attachment; filename="{}"'.format(filename),
+               'Content-Length': str(os.fstat(f.fileno()).st_size)}
+    return StreamingResponse(iterate_in_threadpool(iter_file(f)), media_type='application/octet-stream',
+                             headers=headers)
+
+def add_timing_report(job, entries):
+    with open(job.model_dir + '/timing.json', 'w') as f:
+        json.dump(job.timings, f, indent=2)
+    return entries + [('timing.json', job.model_dir + '/timing.json')]
@@ -0,0 +1,186 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Directories conversions write their files in, with byte quotas and cleanup of the ones a dead worker left behind."""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from tmconverter.metrics import record_workspace
+
+WORKSPACE_DIR = os.environ.get('WORKSPACE_DIR', os.path.join(tempfile.gettempdir(), 'tm_workspaces'))
+# Jobs whose uploads grow to at most WORKSPACE_RAM_JOB_BYTES work in RAM backed WORKSPACE_RAM_DIR, as long as the
+# RAM workspaces fit in it. Set it empty to keep every job on disk.
+WORKSPACE_RAM_DIR = os.environ.get('WORKSPACE_RAM_DIR', '/dev/shm/tm_workspaces' if os.path.isdir('/dev/shm') else '')
+WORKSPACE_RAM_JOB_BYTES = int(os.environ.get('WORKSPACE_RAM_JOB_BYTES', 64 * 1024 ** 2))
+WORKSPACE_RAM_MAX_BYTES = int(os.environ.get('WORKSPACE_RAM_MAX_BYTES', 512 * 1024 ** 2))
+# A job fails once its files grow over WORKSPACE_JOB_MAX_BYTES, requests are turned away while the workspaces would
+# together go over WORKSPACE_MAX_BYTES.
+WORKSPACE_JOB_MAX_BYTES = int(os.environ.get('WORKSPACE_JOB_MAX_BYTES', 4 * 1024 ** 3))
+WORKSPACE_MAX_BYTES = int(os.environ.get('WORKSPACE_MAX_BYTES', 16 * 1024 ** 3))
+# What a conversion is expected to write, the SavedModel, h5, tflite and calibration data, as a multiple of its
+# uploads plus a fixed part for the labels, metadata and converter scratch files.
+WORKSPACE_GROWTH = 4
+WORKSPACE_BASE_BYTES = 16 * 1024 ** 2
+WORKSPACE_SWEEP_SECONDS = int(os.environ.get('WORKSPACE_SWEEP_SECONDS', 300))
+# Workspaces still open after this long belong to a response that never finished, it has to be longer than
+# JOB_TTL_SECONDS since finished jobs keep theirs until they expire.
+WORKSPACE_MAX_AGE_SECONDS = int(os.environ.get('WORKSPACE_MAX_AGE_SECONDS', 3 * 3600))
+# Read-only inputs are copied here once per filesystem and hardlinked into the workspaces.
+SHARED_DIR = 'shared'
+# Open workspaces of this process, by name. Each name starts with the pid of the process that owns it.
+workspaces = {}
+workspaces_lock = threading.Lock()
+
+class Workspace:
+    """The model and data dirs of one job, released exactly once."""
+    def __init__(self, storage, root, reserved_bytes):
+        self.name = '{}-{}'.format(os.getpid(), uuid.uuid4().hex)
+        self.storage = storage
+        self.root = root
+        self.path = os.path.join(root, self.name)
+        self.model_dir = os.path.join(self.path, 'model')
+        self.data_dir = os.path.join(self.path, 'data')
+        self.reserved_bytes = reserved_bytes
+        self.created_at = time.time()
+
+    def used_bytes(self):
+        total = 0
+        for dirname, subdirs, files in os.walk(self.path):
+            for name in files:
+                try:
+                    stat = os.lstat(os.path.join(dirname, name))
+                except FileNotFoundError:
+                    continue
+                # Hardlinked inputs are shared with the other workspaces and take no room of their own.
+                if stat.st_nlink == 1:
+                    total += stat.st_size
+        return total
+
+    def check_quota(self):
+        used = self.used_bytes()
+        with workspaces_lock:
+            # Once a job outgrows its estimate, admission counts what it really holds.
+            self.reserved_bytes = max(self.reserved_bytes, used)
+        if used > WORKSPACE_JOB_MAX_BYTES:
+            raise HTTPException(status_code=507, detail="conversion exceeds its workspace quota")
+
+    def link_input(self, src, dest):
+        """Puts the read-only file src at dest, as a hardlink to a copy shared by every workspace on this filesystem."""
+        stat = os.stat(src)
+        key = '{}:{}:{}'.format(os.path.abspath(src), stat.st_size, stat.st_mtime_ns)
+        shared_dir = os.path.join(self.root, SHARED_DIR)
+        shared = os.path.join(shared_dir, hashlib.sha256(key.encode()).hexdigest())
+        try:
+            if not os.path.isfile(shared):
+                os.makedirs(shared_dir, exist_ok=True)
+                with tempfile.NamedTemporaryFile(dir=shared_dir, suffix='.tmp', delete=False) as f:
+                    with open(src, 'rb') as source:
+                        shutil.copyfileobj(source, f)
+                os.chmod(f.name, 0o444)
+                os.replace(f.name, shared)
+            os.link(shared, dest)
+        except OSError:
+            shutil.copyfile(src, dest)
+
+    def release(self):
+        with workspaces_lock:
+            if workspaces.pop(self.name, None) is None:
+                return
+        print("### DELETING FILES "+self.path, flush=True)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def filesystem_bytes(path):
+    # Docker only gives /dev/shm 64MB by default, far less than WORKSPACE_RAM_MAX_BYTES.
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    stats = os.statvfs(path)
+    return stats.f_blocks * stats.f_frsize
+
+def reserved_bytes():
+    totals = {'ram': 0, 'disk': 0}
+    for workspace in workspaces.values():
+        totals[workspace.storage] += workspace.reserved_bytes
+    return totals
+
+def workspace_usage():
+    with workspaces_lock:
+        return reserved_bytes()
+
+def open_workspace(upload_bytes=0, growth=WORKSPACE_GROWTH):
+    """Reserves room for a job with upload_bytes of uploads and creates its workspace, in RAM if it is small.
+
+    Raises a 503 if the workspaces are full, the client is expected to retry once running jobs have finished.
+    """
+    if upload_bytes > WORKSPACE_JOB_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="upload too large")
+    growth_bytes = upload_bytes * growth
+    estimate = min(growth_bytes + WORKSPACE_BASE_BYTES, WORKSPACE_JOB_MAX_BYTES)
+    with workspaces_lock:
+        reserved = reserved_bytes()
+        if reserved['ram'] + reserved['disk'] + estimate > WORKSPACE_MAX_BYTES:
+            raise HTTPException(status_code=503, detail="converter busy, try again later")
+        # Whether a job is small depends on its uploads alone, the fixed part is the same for every job.
+        if (WORKSPACE_RAM_DIR and growth_bytes <= WORKSPACE_RAM_JOB_BYTES and
+                reserved['ram'] + estimate <= min(WORKSPACE_RAM_MAX_BYTES, filesystem_bytes(WORKSPACE_RAM_DIR))):
+            workspace = Workspace('ram', WORKSPACE_RAM_DIR, estimate)
+        else:
+            workspace = Workspace('disk', WORKSPACE_DIR, estimate)
+        # Registered before the dirs exist, so the sweep never takes them for an orphan.
+        workspaces[workspace.name] = workspace
+    try:
+        os.makedirs(workspace.model_dir)
+        os.makedirs(workspace.data_dir)
+    except Exception:
+        workspace.release()
+        raise
+    record_workspace(workspace.storage)
+    return workspace
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def sweep_workspaces():
+    """Releases the workspaces open past WORKSPACE_MAX_AGE_SECONDS and removes the ones no live worker owns."""
+    now = time.time()
+    with workspaces_lock:
+        stale = [workspace for workspace in workspaces.values() if now - workspace.created_at > WORKSPACE_MAX_AGE_SECONDS]
+    for workspace in stale:
+        workspace.release()
+    for root in (WORKSPACE_DIR, WORKSPACE_RAM_DIR):
+        if not root or not os.path.isdir(root):
+            continue
+        for name in os.listdir(root):
+            pid, _, _ = name.partition('-')
+            if not pid.isdigit():
+                continue
+            with workspaces_lock:
+                if name in workspaces:
+                    continue
+            # Left behind by a worker that crashed, or by this one if it was restarted under the same pid.
+            if int(pid) == os.getpid() or not pid_alive(int(pid)):
+                print("### RECLAIMING WORKSPACE "+name, flush=True)
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
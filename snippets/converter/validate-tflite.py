@@ -0,0 +1,230 @@
+# ==============================================================================
+# Copyright 2021 Google LLC All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""Validates a converted .tflite model over a whole dataset zip.
+
+Runs the model in batches over every image of the dataset and reports accuracy per class, images/sec and
+per invoke latency. Given the original model with --keras (a keras .h5, a tfjs model.json or the uploaded
+tfjs model zip) it also reports top-1 agreement, output drift and the accuracy lost per class. Exits with 1
+when one of the --min-* thresholds is not met. The image and tiny tests run it from their test folder, e.g.
+
+    python ../../validate-tflite.py out/model.tflite image-model-data.zip --keras image-model.zip --min-agreement 0.95
+"""
+
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import PIL.Image
+import tensorflow as tf
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def list_dataset(dataset_zip, labels):
+    """Returns (path, class index) for every image, the class being the image's top level folder."""
+    images = []
+    for name in sorted(dataset_zip.namelist()):
+        folder, _, filename = name.partition('/')
+        if folder == '__MACOSX' or not filename or '/' in filename or filename.startswith('.'):
+            continue
+        if filename.lower().endswith(IMAGE_EXTENSIONS):
+            images.append((name, folder))
+    if labels is None:
+        labels = sorted(set(label for _, label in images))
+    return [(name, labels.index(label)) for name, label in images if label in labels], labels
+
+
+def read_labels(path):
+    # labels.txt as written by the converters, "<index> <label>" per line.
+    with open(path) as f:
+        return [line.rstrip('\n').split(' ', 1)[1] for line in f if line.strip()]
+
+
+def load_image(dataset_zip, name, size, channels):
+    with PIL.Image.open(io.BytesIO(dataset_zip.read(name))) as img:
+        img = img.convert('L' if channels == 1 else 'RGB')
+        if img.size != (size, size):
+            img = img.resize((size, size))
+        array = np.asarray(img, dtype=np.float32)
+    # Same normalization the converters calibrate with.
+    return ((array / 127.5) - 1.0).reshape(size, size, channels)
+
+
+def load_keras_model(path):
+    if path.endswith('.h5'):
+        return tf.keras.models.load_model(path, compile=False)
+    import tensorflowjs as tfjs
+    if path.endswith('.json'):
+        return tfjs.converters.load_keras_model(path)
+    model_dir = tempfile.mkdtemp()
+    try:
+        with zipfile.ZipFile(path) as model_zip:
+            model_zip.extractall(model_dir)
+        return tfjs.converters.load_keras_model(model_dir + '/model.json')
+    finally:
+        shutil.rmtree(model_dir)
+
+
+def make_interpreter(model_path, batch_size, threads, edgetpu):
+    if edgetpu:
+        delegates = [tf.lite.experimental.load_delegate('libedgetpu.so.1')]
+        interpreter = tf.lite.Interpreter(model_path=model_path, experimental_delegates=delegates)
+    else:
+        try:
+            interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=threads)
+        except TypeError:
+            # The TF 1.15 interpreter of the tiny converter has no num_threads.
+            interpreter = tf.lite.Interpreter(model_path=model_path)
+    input_details = interpreter.get_input_details()[0]
+    if batch_size != input_details['shape'][0]:
+        interpreter.resize_tensor_input(input_details['index'], [batch_size] + list(input_details['shape'][1:]))
+    interpreter.allocate_tensors()
+    return interpreter
+
+
+def quantize(batch, details):
+    if details['dtype'] == np.float32:
+        return batch
+    scale, zero_point = details['quantization']
+    info = np.iinfo(details['dtype'])
+    return np.clip(np.round(batch / scale + zero_point), info.min, info.max).astype(details['dtype'])
+
+
+def dequantize(output, details):
+    if details['dtype'] == np.float32:
+        return output
+    scale, zero_point = details['quantization']
+    return (output.astype(np.float32) - zero_point) * scale
+
+
+def run_tflite(interpreter, batches):
+    """Returns the float outputs of all batches and the latency of every invoke."""
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    batch_size = input_details['shape'][0]
+    latencies = []
+    outputs = []
+    for batch in batches:
+        count = len(batch)
+        if count < batch_size:
+            # Pad the last batch instead of reallocating the interpreter for it.
+            batch = np.concatenate([batch, np.zeros((batch_size - count,) + batch.shape[1:], batch.dtype)])
+        interpreter.set_tensor(input_details['index'], quantize(batch, input_details))
+        start = time.perf_counter()
+        interpreter.invoke()
+        latencies.append(time.perf_counter() - start)
+        outputs.append(dequantize(interpreter.get_tensor(output_details['index']), output_details)[:count])
+    return np.concatenate(outputs), latencies
+
+
+def percentiles(values):
+    values = np.asarray(values)
+    return {'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+            'p90': float(np.percentile(values, 90)), 'max': float(values.max())}
+
+
+def per_class_accuracy(predictions, classes, labels):
+    return {label: float(np.mean(predictions[classes == index] == index)) if np.any(classes == index) else None
+            for index, label in enumerate(labels)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Validates a converted .tflite model over a dataset zip.')
+    parser.add_argument('model', help='.tflite model to validate')
+    parser.add_argument('dataset', help='dataset zip with one folder of images per class')
+    parser.add_argument('--keras', help='original model to compare with: keras .h5, tfjs model.json or tfjs model zip')
+    parser.add_argument('--labels', help='labels.txt giving the class order, defaults to the sorted class folders')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='interpreter and decoding threads')
+    parser.add_argument('--edgetpu', action='store_true', help='run an _edgetpu.tflite model on an attached Edge TPU')
+    parser.add_argument('--min-accuracy', type=float)
+    parser.add_argument('--min-agreement', type=float)
+    parser.add_argument('--min-images-per-second', type=float)
+    parser.add_argument('--output', help='file to write the JSON report to, defaults to stdout')
+    args = parser.parse_args()
+
+    # Edge TPU models are compiled for a fixed batch size of one.
+    batch_size = 1 if args.edgetpu else args.batch_size
+    interpreter = make_interpreter(args.model, batch_size, args.threads, args.edgetpu)
+    _, size, _, channels = interpreter.get_input_details()[0]['shape']
+
+    with zipfile.ZipFile(args.dataset) as dataset_zip:
+        images, labels = list_dataset(dataset_zip, read_labels(args.labels) if args.labels else None)
+        if not images:
+            sys.exit('no labelled images in ' + args.dataset)
+        with ThreadPoolExecutor(args.threads) as pool:
+            data = np.stack(list(pool.map(lambda image: load_image(dataset_zip, image[0], size, channels), images)))
+    classes = np.array([index for _, index in images])
+    batches = [data[i:i + batch_size] for i in range(0, len(data), batch_size)]
+
+    start = time.perf_counter()
+    outputs, latencies = run_tflite(interpreter, batches)
+    seconds = time.perf_counter() - start
+    predictions = outputs.argmax(axis=1)
+    report = {
+        'model': os.path.basename(args.model),
+        'model_bytes': os.path.getsize(args.model),
+        'images': len(images),
+        'batch_size': batch_size,
+        'threads': args.threads,
+        'images_per_second': len(images) / seconds,
+        'invoke_latency_seconds': percentiles(latencies),
+        'image_latency_seconds': percentiles([latency / batch_size for latency in latencies]),
+        'accuracy': float(np.mean(predictions == classes)),
+        'class_accuracy': per_class_accuracy(predictions, classes, labels),
+    }
+
+    if args.keras:
+        keras_outputs = load_keras_model(args.keras).predict(data, batch_size=args.batch_size)
+        keras_predictions = keras_outputs.argmax(axis=1)
+        keras_class_accuracy = per_class_accuracy(keras_predictions, classes, labels)
+        drift = np.abs(outputs - keras_outputs)
+        report.update({
+            'keras_accuracy': float(np.mean(keras_predictions == classes)),
+            'agreement': float(np.mean(predictions == keras_predictions)),
+            'output_drift': {'mean': float(drift.mean()), 'max': float(drift.max())},
+            'class_accuracy_loss': {
+                label: None if keras_class_accuracy[label] is None
+                else keras_class_accuracy[label] - report['class_accuracy'][label]
+                for label in labels},
+        })
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    failures = []
+    if args.min_accuracy is not None and report['accuracy'] < args.min_accuracy:
+        failures.append('accuracy {:.3f} < {}'.format(report['accuracy'], args.min_accuracy))
+    if args.min_agreement is not None and report.get('agreement', 0.0) < args.min_agreement:
+        failures.append('agreement {:.3f} < {}'.format(report.get('agreement', 0.0), args.min_agreement))
+    if args.min_images_per_second is not None and report['images_per_second'] < args.min_images_per_second:
+        failures.append('{:.1f} images/sec < {}'.format(report['images_per_second'], args.min_images_per_second))
+    if failures:
+        sys.exit('validation failed: ' + ', '.join(failures))
+
+
+if __name__ == '__main__':
+    main()